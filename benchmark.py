@@ -0,0 +1,93 @@
+"""Compares the default runtime with the fast runtime (`FAST_RUNTIME` in config)
+
+Usage: python benchmark.py [--iterations N]
+
+Measures decoding of typical gateway payloads with `json` and `orjson`, and task throughput of the default event
+loop and uvloop. Packages that aren't installed are skipped.
+"""
+import json
+import time
+import asyncio
+import argparse
+
+# Shaped like the MESSAGE_CREATE, PRESENCE_UPDATE and TYPING_START events we receive the most
+PAYLOADS = [
+    {"t": "MESSAGE_CREATE", "s": 42, "op": 0, "d": {
+        "type": 0, "tts": False, "timestamp": "2021-06-01T12:00:00.000000+00:00", "pinned": False,
+        "mentions": [], "mention_roles": [], "mention_everyone": False, "id": "849248484959240192",
+        "embeds": [], "edited_timestamp": None, "content": "$ask how do I use you? " * 4,
+        "components": [], "channel_id": "81384788765712384", "guild_id": "81384788765712384",
+        "author": {"username": "muffin", "public_flags": 0, "id": "198622483471925248",
+                   "discriminator": "0001", "avatar": "a_bab14f271d565501444b2ca3be944b25"},
+        "member": {"roles": ["81384788765712384", "268187051946835969"], "premium_since": None,
+                   "pending": False, "nick": None, "mute": False, "joined_at": "2016-06-01T12:00:00.000000+00:00",
+                   "hoisted_role": None, "deaf": False}
+    }},
+    {"t": "PRESENCE_UPDATE", "s": 43, "op": 0, "d": {
+        "user": {"id": "198622483471925248"}, "status": "online", "guild_id": "81384788765712384",
+        "client_status": {"desktop": "online"},
+        "activities": [{"type": 0, "name": "Visual Studio Code", "id": "ec0b28a579ecb4bd",
+                        "created_at": 1622548800000, "timestamps": {"start": 1622548000000},
+                        "state": "Workspace: MuffinAIBot", "details": "Editing classes.py",
+                        "assets": {"large_image": "565945770067623946", "large_text": "Editing a PY file"}}]
+    }},
+    {"t": "TYPING_START", "s": 44, "op": 0, "d": {
+        "user_id": "198622483471925248", "timestamp": 1622548800, "channel_id": "81384788765712384",
+        "guild_id": "81384788765712384"
+    }},
+]
+
+
+def bench_decode(loads, messages, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            loads(message)
+    return time.perf_counter() - start
+
+
+def bench_loop(loop, tasks: int) -> float:
+    async def noop():
+        await asyncio.sleep(0)
+
+    async def run():
+        await asyncio.gather(*(noop() for _ in range(tasks)))
+
+    start = time.perf_counter()
+    loop.run_until_complete(run())
+    elapsed = time.perf_counter() - start
+    loop.close()
+    return elapsed
+
+
+def report(name: str, baseline: float, fast: float):
+    print(f"{name:<28}{baseline * 1000:>10.1f}ms{fast * 1000:>10.1f}ms{baseline / fast:>9.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fast runtime against the default one")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    messages = [json.dumps(payload) for payload in PAYLOADS]
+    print(f"{'benchmark':<28}{'default':>12}{'fast':>12}{'speedup':>10}")
+
+    try:
+        import orjson
+    except ImportError:
+        print("orjson is not installed, skipping gateway decoding")
+    else:
+        report("gateway decoding", bench_decode(json.loads, messages, args.iterations),
+               bench_decode(orjson.loads, messages, args.iterations))
+
+    try:
+        import uvloop
+    except ImportError:
+        print("uvloop is not installed, skipping event loop")
+    else:
+        report("event loop tasks", bench_loop(asyncio.new_event_loop(), args.iterations * 5),
+               bench_loop(uvloop.new_event_loop(), args.iterations * 5))
+
+
+if __name__ == "__main__":
+    main()
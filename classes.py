@@ -1,19 +1,37 @@
-import json
 import pathlib
 import os
-from typing import List, Union
+import time
+import asyncio
+import logging
+from typing import List, Union, Dict, Optional
 from dataclasses import dataclass
 
 import discord
 from discord.ext import commands
 
 import utils
+from utils.outbound import Outbound
+from utils.metrics import Metrics
+from utils.prefilter import Prefilter
+from utils.state import save_snapshot, load_snapshot
+from utils.logs import setup_logging
+from utils.loopmon import LoopMonitor
+from utils.tracing import Tracer
+from utils.traffic import TrafficRecorder
+from utils.keys import KeyPool
+from utils.inflight import InFlight
+from utils.runtime import json_loads, enable_fast_runtime
+
+log = logging.getLogger("muffin.bot")
 
 
 @dataclass
 class AIConfig:
     api_key: str
     dm_respond: bool
+    duplicate_threshold: float
+    api_keys: List[dict]
+    api_key_rpm: Optional[int]
 
 
 @dataclass
@@ -24,12 +42,15 @@ class BotConfig:
     command_prefix: Union[str, List[str]]
     ai_config: AIConfig
     whitelist: List[int]
+    log_path: str
+    record_path: str
+    fast_runtime: bool
 
 
 def get_config_from_path(path: str):
     """Reads given config file and parses it into `BotConfig`"""
     with open(path, "r") as file:
-        data = json.loads(file.read())
+        data = json_loads(file.read())
     return BotConfig(
         data.get("TOKEN"),
         data.get("INTENTS"),
@@ -37,21 +58,57 @@ def get_config_from_path(path: str):
         data.get("PREFIX"),
         AIConfig(
             data.get("AI_CONFIG", {"api_key": ""}).get("api_key"),
-            data.get("AI_CONFIG", {"dm_respond": False}).get("dm_respond")
+            data.get("AI_CONFIG", {"dm_respond": False}).get("dm_respond"),
+            data.get("AI_CONFIG", {}).get("duplicate_threshold", 0.8),
+            data.get("AI_CONFIG", {}).get("api_keys", []),
+            data.get("AI_CONFIG", {}).get("api_key_rpm")
         ),
-        data.get("WHITELIST")
+        data.get("WHITELIST"),
+        data.get("LOG_PATH"),
+        data.get("RECORD_PATH"),
+        data.get("FAST_RUNTIME", False)
     )
 
 
 class MuffinBot(commands.Bot):
     """Bot class derived from `commands.Bot` that has additional commands specifically for our purposes"""
 
-    def __init__(self, config_filename: str):
+    def __init__(self, config_filename: str, warm_start: bool = True):
         self.config_path = config_filename
 
-        # Load config
+        # Load config. It's always parsed with the standard library since it says if the fast runtime is enabled
         self.config: BotConfig = get_config_from_path(self.config_path)
 
+        # Write logs from a background thread so a slow sink can't block the event loop
+        self.log_listener = setup_logging(self.config.log_path)
+
+        # OpenAI API keys picked per request
+        self.key_pool = KeyPool.from_config(self.config.ai_config)
+
+        # Counters and observations of what the bot is doing
+        self.metrics = Metrics()
+        self.loop_monitor = LoopMonitor(self.metrics)
+        self.tracer = Tracer()
+
+        # Outbound message pipeline with a queue per channel
+        self.outbound = Outbound(self.metrics)
+
+        # Sanitized command traffic recording for offline benchmarks, off unless RECORD_PATH is set
+        self.recorder = TrafficRecorder(self.config.record_path) if self.config.record_path else None
+
+        # Local content classifier that runs before the remote one
+        self.prefilter = Prefilter.from_path(os.path.join(self.config.data_path, "filters"))
+
+        # In-flight AI commands by invoking message ID, cancelled if the message is deleted, and graceful shutdown state
+        self.in_flight: Dict[int, InFlight] = {}
+        self.shutting_down = False
+        self.shutdown_deadline = 30
+        self.snapshot_path = os.path.join(self.config.data_path, "state.json.gz")
+
+        # Install uvloop and orjson before commands.Bot creates the event loop
+        if self.config.fast_runtime:
+            log.info(f"Fast runtime enabled with: {', '.join(enable_fast_runtime()) or 'nothing'}")
+
         # Create intents
         intents = discord.Intents()
         for intent in self.config.intents:
@@ -68,24 +125,151 @@ class MuffinBot(commands.Bot):
                     continue
                 self.load_extension(line.strip())
 
+        # Warm up caches from the last run
+        if warm_start:
+            self.load_state()
+
     async def on_ready(self):
-        print(f"Bot is ready!\n"
-              f"========================================\n"
-              f"User:\t\t\t{self.user}\n"
-              f"ID:\t\t\t\t{self.user.id}\n"
-              f"Guild Count:\t{len(self.guilds)}\n"
-              f"========================================")
         active_intents = [i[0].upper() for i in list(self.intents) if i[1]]
-        print(f"Running with intents: {', '.join(active_intents)}")
+        log.info(f"Bot is ready as {self.user} ({self.user.id}) in {len(self.guilds)} guilds "
+                 f"with intents: {', '.join(active_intents)}")
+
+    async def invoke(self, ctx: commands.Context):
+        """Invokes the command inside a trace"""
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        if self.recorder is not None:
+            self.recorder.record(ctx)
+        with self.tracer.trace(f"command:{ctx.command.qualified_name}", guild=ctx.guild.id if ctx.guild else None,
+                               user=ctx.author.id):
+            await super().invoke(ctx)
+
+    def cancel_in_flight(self, record: InFlight):
+        """Cancels AI work whose message or channel was deleted and records the tokens it saved once it stops"""
+        if record.cancelled or record.task.done():
+            return
+        record.cancelled = True
+        record.task.cancel()
+        self.metrics.increment("in_flight.cancelled")
+
+        def account(_):
+            self.metrics.increment("in_flight.tokens_saved", record.saved_tokens)
+            self.metrics.increment("in_flight.tokens_lost", record.lost_tokens)
+            log.info("Cancelled AI work of a deleted message", extra={"tokens": record.saved_tokens})
+        record.task.add_done_callback(account)
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        record = self.in_flight.pop(payload.message_id, None)
+        if record is not None:
+            self.cancel_in_flight(record)
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        for message_id in payload.message_ids:
+            record = self.in_flight.pop(message_id, None)
+            if record is not None:
+                self.cancel_in_flight(record)
+
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        for message_id, record in list(self.in_flight.items()):
+            if record.channel_id == channel.id:
+                del self.in_flight[message_id]
+                self.cancel_in_flight(record)
+        self.outbound.cancel_channel(channel.id)
 
     def get_data_path(self, path: str = ""):
         """Gets file path relative to bot data path"""
-        path = os.path.join(self.data_path, path)
+        path = os.path.join(self.config.data_path, path)
         dir_path = pathlib.Path(os.path.dirname(path))
         if not dir_path.exists():
             dir_path.mkdir(parents=True, exist_ok=True)
         return path
 
+    def get_guild_data_path(self, guild_id: int, path: str = ""):
+        """Gets file path relative to the guild's data path"""
+        return self.get_data_path(os.path.join("guilds", str(guild_id), path))
+
+    def export_cog_states(self, cogs: List["MuffinCog"]) -> dict:
+        """Returns the warm state of the cogs with their state versions, leaving out cogs without state"""
+        states = {}
+        for cog in cogs:
+            state = cog.export_state()
+            if state:
+                states[cog.qualified_name] = {"version": cog.state_version, "state": state}
+        return states
+
+    def import_cog_states(self, states: dict, saved_at: float) -> List[str]:
+        """Restores states returned by `export_cog_states` into the current cogs with the same name and state version
+
+        :returns: Names of the cogs the state was restored into
+        """
+        restored = []
+        for name, data in states.items():
+            cog = self.get_cog(name)
+            if not isinstance(cog, MuffinCog):
+                continue
+            if data.get("version") != cog.state_version:
+                log.warning(f"Discarded state of {name} from state version {data.get('version')}, "
+                            f"expected {cog.state_version}")
+                continue
+            cog.import_state(data["state"], saved_at)
+            restored.append(name)
+        return restored
+
+    def save_state(self):
+        """Saves warm state of the bot and its cogs to the snapshot file"""
+        cogs = self.export_cog_states([cog for cog in self.cogs.values() if isinstance(cog, MuffinCog)])
+        save_snapshot(self.snapshot_path, {"metrics": dict(self.metrics.counters), "cogs": cogs})
+
+    def load_state(self):
+        """Loads warm state saved by `save_state` if there is any"""
+        data = load_snapshot(self.snapshot_path)
+        if data is None:
+            return
+        self.metrics.counters.update(data.get("metrics", {}))
+        self.import_cog_states(data.get("cogs", {}), data["saved_at"])
+
+    def reload_extension(self, name: str) -> List[str]:
+        """Reloads the extension and hands the warm state of its cogs over to the reloaded cogs
+
+        If the reload fails, the state goes to the cogs the old extension is set up with again.
+        :returns: Names of the cogs the state was restored into
+        """
+        cogs = [cog for cog in self.cogs.values()
+                if isinstance(cog, MuffinCog) and (cog.__module__ == name or cog.__module__.startswith(name + "."))]
+        states = self.export_cog_states(cogs)
+        saved_at = time.time()
+        try:
+            super().reload_extension(name)
+        finally:
+            restored = self.import_cog_states(states, saved_at)
+        return restored
+
+    async def drain(self, timeout: float):
+        """Stops accepting AI commands and waits up to `timeout` seconds for in-flight commands and sends"""
+        self.shutting_down = True
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+
+        if self.in_flight:
+            await asyncio.wait({record.task for record in self.in_flight.values()}, timeout=timeout)
+        await self.outbound.drain(max(0.0, deadline - loop.time()))
+
+    async def close(self):
+        """Drains in-flight work and saves warm state before closing the bot"""
+        if not self.shutting_down:
+            await self.drain(self.shutdown_deadline)
+            self.save_state()
+        if self.recorder is not None:
+            self.recorder.flush()
+        self.loop_monitor.stop()
+        await super().close()
+        self.log_listener.stop()
+
+    async def start(self, *args, **kwargs):
+        """Starts monitoring the event loop and connects to Discord"""
+        self.loop_monitor.start()
+        await super().start(*args, **kwargs)
+
     def run(self, *args, **kwargs):
         """Starts the bot with TOKEN in the config"""
         # Get token
@@ -102,5 +286,16 @@ class MuffinCog(commands.Cog):
     __slots__ = "bot"
     category = "other"
 
+    # Increase when the format of `export_state` changes so state in the old format isn't imported
+    state_version = 1
+
     def __init__(self, bot: MuffinBot):
         self.bot: MuffinBot = bot
+
+    def export_state(self) -> dict:
+        """Returns JSON serializable warm state of the cog to be saved in the snapshot"""
+        return {}
+
+    def import_state(self, state: dict, saved_at: float):
+        """Restores warm state returned by `export_state` in an earlier run at `saved_at` unix time"""
+        pass
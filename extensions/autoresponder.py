@@ -0,0 +1,146 @@
+import re
+import asyncio
+import logging
+from contextlib import suppress
+from typing import Dict, List, Optional, Tuple
+
+import openai
+import discord
+from discord.ext import commands
+
+import utils
+from utils import contexts, checks, inflight
+from classes import MuffinBot, MuffinCog
+
+log = logging.getLogger("muffin.autoresponder")
+
+MENTION = re.compile(r"<@!?\d+>")
+
+
+class PendingResponse:
+    """Messages of a user in a channel that are waiting to be answered together"""
+    __slots__ = ("parts", "message_ids", "task")
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.message_ids: List[int] = []
+        self.task: Optional[asyncio.Task] = None
+
+
+class AutoResponder(MuffinCog):
+    """Answers mentions and, if `dm_respond` is enabled, DMs using the helpbot context"""
+    category = "AI"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Seconds to wait for more messages before answering, and limits of the merged prompt
+        self.debounce = 2.0
+        self.max_parts = 5
+        self.max_length = 500
+
+        self.pending: Dict[Tuple[int, int], PendingResponse] = {}
+
+    def cog_unload(self):
+        for pending in self.pending.values():
+            if pending.task is not None:
+                pending.task.cancel()
+
+    def _should_respond(self, message: discord.Message) -> bool:
+        if message.author.bot or self.bot.shutting_down:
+            return False
+        if message.guild is None:
+            return self.bot.config.ai_config.dm_respond
+        return self.bot.user in message.mentions
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        if not self._should_respond(message):
+            return
+
+        # Leave commands to the command handler
+        ctx = await self.bot.get_context(message)
+        if ctx.valid:
+            return
+
+        # Only whitelisted users can use the API
+        try:
+            await checks.is_whitelisted(ctx)
+        except utils.WhitelistOnly:
+            return
+
+        text = MENTION.sub("", message.content).strip()
+        if not text:
+            return
+
+        # Merge the message into the pending prompt and restart the debounce, cancelling the older pending answer
+        key = (message.channel.id, message.author.id)
+        pending = self.pending.setdefault(key, PendingResponse())
+        pending.parts = (pending.parts + [text])[-self.max_parts:]
+        pending.message_ids = (pending.message_ids + [message.id])[-self.max_parts:]
+        if pending.task is not None:
+            pending.task.cancel()
+            self.bot.metrics.increment("autoresponder.coalesced")
+        pending.task = asyncio.ensure_future(self._respond(key, pending, ctx))
+
+    async def _respond(self, key: Tuple[int, int], pending: PendingResponse, ctx: commands.Context):
+        message = ctx.message
+
+        # Deleting any of the merged messages cancels the answer
+        record = inflight.track(message.channel.id)
+        message_ids = list(pending.message_ids)
+        for message_id in message_ids:
+            self.bot.in_flight[message_id] = record
+        try:
+            await asyncio.sleep(self.debounce)
+
+            # Share the cooldown of `ask` so mentions don't get around it
+            questions = self.bot.get_cog("Questions")
+            if questions is None:
+                return
+            await questions.check_cooldown(ctx)
+
+            prompt = " ".join(pending.parts)[-self.max_length:]
+            guild_id = message.guild.id if message.guild else None
+            if not await checks.is_text_appropriate(self.bot, prompt, guild_id):
+                return await utils.raise_failure(message.channel, str(utils.TextInappropriate()))
+
+            context = contexts.create_question_context(self.bot.config.data_path, prompt, self.bot.user.display_name,
+                                                       guild_id)
+            async with message.channel.typing():
+                result = await utils.create_completion_result_from_context(self.bot.loop, context,
+                                                                           pool=self.bot.key_pool, guild_id=guild_id)
+            self.bot.metrics.increment("autoresponder.responses")
+            with suppress(discord.HTTPException):
+                await self.bot.outbound.send(message.channel, result)
+        except commands.CommandOnCooldown as e:
+            await utils.raise_failure(message.channel, f"You have to wait `{int(e.retry_after)}` seconds to ask again")
+        except utils.APIUnavailable as e:
+            log.warning("Auto response skipped, API unavailable", extra={
+                "guild": message.guild.id if message.guild else None, "user": message.author.id
+            })
+            await utils.raise_failure(message.channel, str(e))
+        except openai.error.RateLimitError:
+            await utils.raise_failure(message.channel, "The AI is too busy right now, try again later")
+        except openai.error.APIConnectionError as e:
+            await utils.raise_failure(message.channel, e.user_message)
+        except openai.error.OpenAIError:
+            log.exception("Auto response failed", extra={
+                "guild": message.guild.id if message.guild else None, "user": message.author.id
+            })
+            await utils.raise_failure(message.channel, "The AI failed to respond, try again later")
+        except discord.HTTPException:
+            log.warning("Auto response couldn't be sent", extra={
+                "guild": message.guild.id if message.guild else None, "user": message.author.id
+            })
+        finally:
+            for message_id in message_ids:
+                if self.bot.in_flight.get(message_id) is record:
+                    del self.bot.in_flight[message_id]
+            # A newer message replaces this task and keeps the parts, otherwise they've been answered
+            if pending.task is asyncio.current_task():
+                del self.pending[key]
+
+
+def setup(bot: MuffinBot):
+    bot.add_cog(AutoResponder(bot))
@@ -4,8 +4,14 @@ import asyncio
 import textwrap
 import io
 import sys
+import gc
+import json
+import logging
+import tracemalloc
+from collections import Counter
 from datetime import datetime
 from contextlib import suppress
+from typing import Optional
 
 import psutil
 import discord
@@ -14,6 +20,19 @@ from discord.ext import commands
 from utils import checks
 from classes import MuffinBot, MuffinCog
 
+log = logging.getLogger("muffin.debug")
+
+# Modules whose types are counted by `heap objects`
+OWN_MODULES = ("classes", "utils", "extensions")
+
+
+def take_heap_snapshot() -> tracemalloc.Snapshot:
+    """Takes a snapshot without tracemalloc's own and import machinery allocations"""
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
 
 def format_code(py_code, prefix, command):
     if py_code.lower().startswith(f"{prefix}{command}"):
@@ -72,23 +91,23 @@ async def exec_async(code, context=None):
 async def try_exec_async(code, ctx, context=None, message=None):
     try:
         if not message:
-            message = await ctx.send("Executing...")
+            message = await ctx.bot.outbound.send(ctx.channel, "Executing...")
         else:
-            await message.edit(content='Executing...')
+            await ctx.bot.outbound.edit(message, content='Executing...')
 
         future = asyncio.ensure_future(exec_async(code, context))
         result = await future
 
         with suppress(Exception):
-            await ctx.message.add_reaction("✅")
+            await ctx.bot.outbound.add_reactions(ctx.message, "✅")
 
-        await message.edit(content=f"```py\n{result if result else None}\n```")
+        await ctx.bot.outbound.edit(message, content=f"```py\n{result if result else None}\n```")
     except SyntaxError as se:
         if se.text is None:
-            await message.edit(content=f"```py\n{se.__class__.__name__} {se}\n```")
-        await message.edit(content=f"```py\nSyntaxError: {se.text} {'^':>{se.offset}}\n{type(se).__name__}: {se}\n```")
+            await ctx.bot.outbound.edit(message, content=f"```py\n{se.__class__.__name__} {se}\n```")
+        await ctx.bot.outbound.edit(message, content=f"```py\nSyntaxError: {se.text} {'^':>{se.offset}}\n{type(se).__name__}: {se}\n```")
     except Exception as ex:
-        await message.edit(content=f"```py\nException: {ex}\n```")
+        await ctx.bot.outbound.edit(message, content=f"```py\nException: {ex}\n```")
 
     return message
 
@@ -101,21 +120,48 @@ class Debug(MuffinCog):
         self.process = psutil.Process()
         self.cureval = []
 
+        # Heap profiling state, nothing is traced or sampled until an owner starts it
+        self.heap_snapshot: Optional[tracemalloc.Snapshot] = None
+        self.heap_sampler: Optional[asyncio.Task] = None
+
+    def cog_unload(self):
+        if self.heap_sampler is not None:
+            self.heap_sampler.cancel()
+
+    def _heap_usage(self) -> float:
+        """Returns traced memory if tracemalloc is running, otherwise USS in MiB"""
+        if tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0] / 1024 ** 2
+        return self.process.memory_full_info().uss / 1024 ** 2
+
+    async def _sample_heap(self, interval: float):
+        """Logs heap usage and its growth rate every `interval` seconds"""
+        first_time, first_usage = time.monotonic(), self._heap_usage()
+        last_usage = first_usage
+        while True:
+            await asyncio.sleep(interval)
+            usage = self._heap_usage()
+            hours = (time.monotonic() - first_time) / 3600
+            log.info(f"Heap usage {usage:.2f} MiB ({usage - last_usage:+.2f} MiB since last sample, "
+                     f"{(usage - first_usage) / hours:+.2f} MiB/h since start)")
+            self.bot.metrics.set("heap.usage_mib", usage)
+            last_usage = usage
+
+    @commands.check(checks.is_owner)
     @commands.command(hidden=True)
     async def shutdown(self, ctx: commands.Context):
-        await ctx.send("This is unfai-")
-        await self.bot.logout()
+        """Waits for in-flight AI commands, saves warm state and shuts the bot down. Only usable by owners"""
+        await self.bot.outbound.send(ctx.channel, "This is unfai-")
         await self.bot.close()
-        await self.bot.loop.close()
 
     @commands.command()
     async def ping(self, ctx: commands.Context):
         """Measures latency between discord servers and bot server"""
         before = time.monotonic()
-        msg = await ctx.send("Pong!")
+        msg = await self.bot.outbound.send(ctx.channel, "Pong!")
         ping = (time.monotonic() - before) * 1000
         heartbeat = int(self.bot.latency * 1000)
-        await msg.edit(content=f":ping_pong: Pong! Took: `{int(ping)}ms` (Heartbeat: `{heartbeat}ms`)")
+        await self.bot.outbound.edit(msg, content=f":ping_pong: Pong! Took: `{int(ping)}ms` (Heartbeat: `{heartbeat}ms`)")
 
     @commands.check(checks.is_owner)
     @commands.command(aliases=["stats"])
@@ -123,7 +169,7 @@ class Debug(MuffinCog):
         """Gives information about bot's status"""
         # Measure ping first
         before = time.monotonic()
-        msg = await ctx.send("Working...")
+        msg = await self.bot.outbound.send(ctx.channel, "Working...")
         ping = int((time.monotonic() - before) * 1000)
         heartbeat = int(self.bot.latency * 1000)
 
@@ -165,25 +211,136 @@ class Debug(MuffinCog):
             name="Process", value=f"Memory Usage: `{memory_usage:.2f} MiB`\nCPU Usage: `{cpu_usage:.2f}%`",
             inline=False)
 
+        # Get event loop lag
+        lag = [self.bot.loop_monitor.percentile(p) for p in (0.5, 0.95, 0.99)]
+        if lag[0] is not None:
+            p50, p95, p99 = (int(value * 1000) for value in lag)
+            slow_callbacks = self.bot.metrics.counters["loop.slow_callbacks"]
+            emb.add_field(
+                name="Event Loop",
+                value=f"Lag: `{p50}ms` p50, `{p95}ms` p95, `{p99}ms` p99\nSlow Callbacks: `{slow_callbacks}`",
+                inline=False)
+
         # Add other information
         version = pkg_resources.get_distribution('discord.py').version
         emb.set_footer(text=f"discord.py v{version}")
         emb.timestamp = datetime.utcnow()
         emb.set_thumbnail(url=self.bot.user.avatar_url)
-        await msg.edit(embed=emb, content=None)
+        await self.bot.outbound.edit(msg, embed=emb, content=None)
+
+    @commands.check(checks.is_owner)
+    @commands.command(hidden=True)
+    async def metrics(self, ctx: commands.Context):
+        """Shows the bot metrics. Only usable by owners"""
+        metrics = self.bot.metrics
+        emb = discord.Embed(title="Metrics", colour=discord.Colour.blurple())
+
+        # Share of prompts the prefilter decided on without the API
+        local = metrics.rate("prefilter.safe", "prefilter.") + metrics.rate("prefilter.unsafe", "prefilter.")
+        emb.description = f"Prefilter local decisions: `{local:.0%}`"
+
+        counters = "\n".join(f"{name}: `{value}`" for name, value in sorted(metrics.counters.items()))
+        emb.add_field(name="Counters", value=counters[:1024] or "None", inline=False)
+        gauges = "\n".join(f"{name}: `{value:.2f}`" for name, value in sorted(metrics.gauges.items()))
+        emb.add_field(name="Gauges", value=gauges[:1024] or "None", inline=False)
+        observations = "\n".join(
+            f"{name}: `{metrics.percentile(name, 0.5):.3f}` p50, `{metrics.percentile(name, 0.99):.3f}` p99"
+            for name in sorted(metrics.observations))
+        emb.add_field(name="Observations", value=observations[:1024] or "None", inline=False)
+        await self.bot.outbound.send(ctx.channel, embed=emb)
+
+    @commands.check(checks.is_owner)
+    @commands.group(hidden=True, invoke_without_command=True)
+    async def heap(self, ctx: commands.Context):
+        """Heap and allocation profiling. Only usable by owners"""
+        tracing = "on" if tracemalloc.is_tracing() else "off"
+        sampler = "on" if self.heap_sampler is not None and not self.heap_sampler.done() else "off"
+        await self.bot.outbound.send(ctx.channel, f"Tracing: `{tracing}`\nSampler: `{sampler}`\n"
+                                                  f"Heap usage: `{self._heap_usage():.2f} MiB`")
+
+    @commands.check(checks.is_owner)
+    @heap.command(name="start")
+    async def heap_start(self, ctx: commands.Context, frames: int = 1):
+        """Starts tracing allocations with `frames` stack frames per allocation"""
+        if tracemalloc.is_tracing():
+            return await self.bot.outbound.send(ctx.channel, "Already tracing")
+        tracemalloc.start(frames)
+        self.heap_snapshot = take_heap_snapshot()
+        await self.bot.outbound.send(ctx.channel, f"Started tracing with `{frames}` frames")
+
+    @commands.check(checks.is_owner)
+    @heap.command(name="stop")
+    async def heap_stop(self, ctx: commands.Context):
+        """Stops tracing allocations and frees the traces"""
+        tracemalloc.stop()
+        self.heap_snapshot = None
+        await self.bot.outbound.send(ctx.channel, "Stopped tracing")
+
+    @commands.check(checks.is_owner)
+    @heap.command(name="snapshot", aliases=["diff"])
+    async def heap_diff(self, ctx: commands.Context, top: int = 10):
+        """Takes a snapshot and shows the top allocation sites by growth since the previous one"""
+        if not tracemalloc.is_tracing():
+            return await self.bot.outbound.send(ctx.channel, "Not tracing, start it first")
+
+        snapshot = take_heap_snapshot()
+        if self.heap_snapshot is None:
+            # Tracing was started without `heap start`, e.g. by PYTHONTRACEMALLOC
+            self.heap_snapshot = snapshot
+            return await self.bot.outbound.send(ctx.channel, "Took the baseline snapshot, run it again to compare")
+        stats = sorted(snapshot.compare_to(self.heap_snapshot, "lineno"), key=lambda stat: stat.size_diff,
+                       reverse=True)
+        stats = [stat for stat in stats if stat.size_diff > 0][:top]
+        self.heap_snapshot = snapshot
+
+        lines = [f"{stat.size_diff / 1024:+.1f} KiB ({stat.count_diff:+}) {stat.traceback[0]}" for stat in stats]
+        await self.bot.outbound.send(ctx.channel, "```\n" + ("\n".join(lines) or "No growth")[:1990] + "\n```")
+
+    @commands.check(checks.is_owner)
+    @heap.command(name="objects")
+    async def heap_objects(self, ctx: commands.Context, top: int = 15):
+        """Shows live object counts of the bot's own types"""
+        counts = Counter(f"{type(obj).__module__}.{type(obj).__qualname__}" for obj in gc.get_objects()
+                         if type(obj).__module__.split(".")[0] in OWN_MODULES)
+        lines = [f"{count:>8} {name}" for name, count in counts.most_common(top)]
+        await self.bot.outbound.send(ctx.channel, "```\n" + ("\n".join(lines) or "None")[:1990] + "\n```")
+
+    @commands.check(checks.is_owner)
+    @heap.command(name="sampler")
+    async def heap_sampler_toggle(self, ctx: commands.Context, interval: Optional[float] = 300):
+        """Starts or stops logging heap usage every `interval` seconds"""
+        if self.heap_sampler is not None and not self.heap_sampler.done():
+            self.heap_sampler.cancel()
+            self.heap_sampler = None
+            return await self.bot.outbound.send(ctx.channel, "Stopped heap sampler")
+        interval = max(interval, 1)
+        self.heap_sampler = asyncio.ensure_future(self._sample_heap(interval))
+        await self.bot.outbound.send(ctx.channel, f"Sampling heap every `{interval}` seconds")
+
+    @commands.check(checks.is_owner)
+    @commands.command(hidden=True)
+    async def traces(self, ctx: commands.Context):
+        """Exports slow and sampled command traces as Chrome trace JSON. Only usable by owners"""
+        tracer = self.bot.tracer
+        if not tracer.traces:
+            return await self.bot.outbound.send(ctx.channel, "No traces yet")
+        data = json.dumps(tracer.export_chrome()).encode()
+        await self.bot.outbound.send(ctx.channel, f"`{len(tracer.traces)}` traces, open in `chrome://tracing`",
+                                     file=discord.File(io.BytesIO(data), filename="traces.json"))
 
     @commands.check(checks.is_owner)
     @commands.command(name="reload")
     async def reload_cog(self, ctx: commands.Context, *, extension: str):
         """Reloads the extension. Only usable by owners"""
         if f"extensions.{extension}" not in self.bot.extensions:
-            return await ctx.send("Unknown cog")
-        sent_message = await ctx.send(f"Reloading `{extension}`")
+            return await self.bot.outbound.send(ctx.channel, "Unknown cog")
+        sent_message = await self.bot.outbound.send(ctx.channel, f"Reloading `{extension}`")
         try:
-            self.bot.reload_extension(f"extensions.{extension}")
+            restored = self.bot.reload_extension(f"extensions.{extension}")
         except Exception as e:
-            return await ctx.send(f"Error occurred: `{e}`")
-        await sent_message.edit(content=f"Successfully reloaded `{extension}`")
+            return await self.bot.outbound.send(ctx.channel, f"Error occurred: `{e}`")
+        kept = f", kept the state of `{', '.join(restored)}`" if restored else ""
+        await self.bot.outbound.edit(sent_message, content=f"Successfully reloaded `{extension}`{kept}")
 
     @commands.check(checks.is_owner)
     @commands.command(aliases=["exec", "e"])
@@ -4,7 +4,7 @@ import openai
 import discord
 from discord.ext import commands
 
-from utils import raise_failure
+from utils import raise_failure, APIUnavailable
 from classes import MuffinBot, MuffinCog
 
 
@@ -15,7 +15,10 @@ class ErrorHandler(MuffinCog):
     @commands.Cog.listener()
     async def on_command_error(self, ctx: commands.Context, error):
         """Global error handler. Should only work if the error is not handled by the command itself."""
-        if isinstance(error, commands.MissingPermissions):
+        # Raised directly when the API fails inside a check
+        if isinstance(error, APIUnavailable):
+            await raise_failure(ctx.message.channel, str(error))
+        elif isinstance(error, commands.MissingPermissions):
             await raise_failure(ctx.message.channel, f"You lack the permission to do this {ctx.author.mention}!")
         elif isinstance(error, commands.BotMissingPermissions):
             await raise_failure(ctx.message.channel, f"I lack the permission to do this!")
@@ -54,8 +57,14 @@ class ErrorHandler(MuffinCog):
                 await raise_failure(ctx.message.channel, f"I lack the permission to do this!")
             elif isinstance(error.original, asyncio.TimeoutError):
                 await ctx.send("Too late!")
+            elif isinstance(error.original, APIUnavailable):
+                await raise_failure(ctx.message.channel, str(error.original))
+            elif isinstance(error.original, openai.error.RateLimitError):
+                await raise_failure(ctx.message.channel, "The AI is too busy right now, try again later")
             elif isinstance(error.original, openai.error.APIConnectionError):
                 await raise_failure(ctx.message.channel, error.original.user_message)
+            elif isinstance(error.original, openai.error.OpenAIError):
+                await raise_failure(ctx.message.channel, "The AI failed to respond, try again later")
             else:
                 raise error.original
         else:
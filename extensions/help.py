@@ -100,7 +100,7 @@ class Help(MuffinCog):
             embed.add_field(name="Available Categories",
                             value='\n'.join([cat.title() for cat in self._get_categories()]),
                             inline=False)
-            return await ctx.send(embed=embed)
+            return await self.bot.outbound.send(ctx.channel, embed=embed)
 
         # Give information about the command if command was provided
         if command:
@@ -122,7 +122,7 @@ class Help(MuffinCog):
             if isinstance(command, commands.Group):
                 embed.add_field(name="Subcommands", value=', '.join(f"`{c.qualified_name}`" for c in command.commands),
                                 inline=False)
-            return await ctx.send(embed=embed)
+            return await self.bot.outbound.send(ctx.channel, embed=embed)
 
         # Give a list of commands in category if category was provided
         if category:
@@ -132,15 +132,12 @@ class Help(MuffinCog):
             current_page = 0
             embed, page_count = self._generate_command_list(category, current_page)
             embed.set_author(name=str(ctx.author), icon_url=ctx.author.avatar_url)
-            sent_message = await ctx.send(embed=embed)
+            sent_message = await self.bot.outbound.send(ctx.channel, embed=embed)
 
             # React to message and wait for reactions in a while loop if page count is more than 1
             if page_count > 1:
+                await self.bot.outbound.add_reactions(sent_message, "◀", "▶", "⏺")
                 while 1:
-                    await sent_message.add_reaction("◀")
-                    await sent_message.add_reaction("▶")
-                    await sent_message.add_reaction("⏺")
-
                     # Wait for the reactions
                     try:
                         def check(r, u):
@@ -150,25 +147,21 @@ class Help(MuffinCog):
                     # Handle timeout
                     except asyncio.TimeoutError:
                         try:
-                            await sent_message.clear_reactions()
+                            await self.bot.outbound.clear_reactions(sent_message)
                         except discord.Forbidden:
-                            await sent_message.remove_reaction("◀", self.bot.user)
-                            await sent_message.remove_reaction("▶", self.bot.user)
-                            await sent_message.remove_reaction("⏺", self.bot.user)
+                            await self.bot.outbound.remove_reactions(sent_message, self.bot.user, "◀", "▶", "⏺")
                         break
 
                     # Remove the new reaction for clarity
                     with suppress(discord.Forbidden):
-                        await reaction.remove(user)
+                        await self.bot.outbound.remove_reactions(sent_message, user, reaction.emoji)
 
                     # Pin the message
                     if reaction.emoji == "⏺":
                         try:
-                            await sent_message.clear_reactions()
+                            await self.bot.outbound.clear_reactions(sent_message)
                         except discord.Forbidden:
-                            await sent_message.remove_reaction("◀", self.bot.user)
-                            await sent_message.remove_reaction("▶", self.bot.user)
-                            await sent_message.remove_reaction("⏺", self.bot.user)
+                            await self.bot.outbound.remove_reactions(sent_message, self.bot.user, "◀", "▶", "⏺")
                         break
 
                     # Go to previous page
@@ -178,7 +171,7 @@ class Help(MuffinCog):
                         current_page -= 1
                         embed, _ = self._generate_command_list(category, current_page)
                         embed.set_author(name=str(ctx.author), icon_url=ctx.author.avatar_url)
-                        await sent_message.edit(embed=embed)
+                        await self.bot.outbound.edit(sent_message, embed=embed)
 
                     # Go to next page
                     if reaction.emoji == "▶":
@@ -187,7 +180,7 @@ class Help(MuffinCog):
                         current_page += 1
                         embed, _ = self._generate_command_list(category, current_page)
                         embed.set_author(name=str(ctx.author), icon_url=ctx.author.avatar_url)
-                        await sent_message.edit(embed=embed)
+                        await self.bot.outbound.edit(sent_message, embed=embed)
 
 
 def setup(bot: MuffinBot):
@@ -1,55 +1,203 @@
-from typing import Optional
+import time
+import asyncio
+import logging
+from typing import Optional, Tuple
+from contextlib import suppress
 from datetime import datetime, timedelta
 
+import openai
+import discord
 from discord.ext import commands
 
 import utils
-from utils import contexts, checks
+from utils import contexts, checks, tracing, inflight
+from utils.dedup import NearDuplicateIndex
+from utils.continuations import Continuation, ContinuationStore
+from utils.memory import ConversationMemory
 from classes import MuffinCog, MuffinBot
 
+log = logging.getLogger("muffin.questions")
+
+CONTINUE_EMOJI = "⏩"
+
 
 class Questions(MuffinCog):
     category = "AI"
+    state_version = 2
     
     def __init__(self, *args, **kwargs):
         super(Questions, self).__init__(*args, **kwargs)
 
-        # Setup OpenAI API
-        utils.setup_openai(self.bot.config.ai_config.api_key)
-
         # Per-user invocation time dict and config for cooldowns
         self.enable_cooldown = True
         self.cooldown = 120
         self.invocation_times = {}
 
-        print("Questions Module Loaded.")
+        # Recently answered questions to reuse answers of near-duplicate questions
+        self.answered_questions = NearDuplicateIndex(threshold=self.bot.config.ai_config.duplicate_threshold)
+
+        # Recent turns of channels in conversation mode, added to `ask` prompts
+        self.conversations = ConversationMemory()
+
+        # Long outputs are generated a chunk at a time, the next chunk only when the author reacts to continue
+        self.continuations = ContinuationStore()
+        self.chunk_tokens = 128
+        self.max_chunks = 5
+
+        log.info("Questions module loaded")
+
+    async def cog_check(self, ctx: commands.Context):
+        """Stops accepting new AI commands while the bot is shutting down"""
+        if self.bot.shutting_down:
+            raise utils.ShuttingDown()
+        return True
 
+    async def cog_before_invoke(self, ctx: commands.Context):
+        self.bot.in_flight[ctx.message.id] = inflight.track(ctx.channel.id)
+        ctx.invoked_at = time.monotonic()
+
+    async def cog_after_invoke(self, ctx: commands.Context):
+        self.bot.in_flight.pop(ctx.message.id, None)
+        log.info("Command completed", extra={
+            "command": str(ctx.command), "guild": ctx.guild.id if ctx.guild else None, "user": ctx.author.id,
+            "latency": time.monotonic() - ctx.invoked_at
+        })
+
+    def export_state(self) -> dict:
+        now = datetime.utcnow()
+        return {
+            "invocation_times": [[user_id, (now - last_time).total_seconds()]
+                                 for user_id, last_time in self.invocation_times.items()
+                                 if (now - last_time).total_seconds() < self.cooldown],
+            "answered_questions": self.answered_questions.export(),
+            "conversations": self.conversations.export(),
+            "continuations": self.continuations.export()
+        }
+
+    def import_state(self, state: dict, saved_at: float):
+        downtime = max(0.0, time.time() - saved_at)
+        now = datetime.utcnow()
+        for user_id, age in state.get("invocation_times", []):
+            if age + downtime < self.cooldown:
+                self.invocation_times[user_id] = now - timedelta(seconds=age + downtime)
+        self.answered_questions.load(state.get("answered_questions", {}), downtime)
+        self.conversations.load(state.get("conversations", {}), downtime)
+        self.continuations.load(state.get("continuations", {}), downtime)
+
+    async def complete_context(self, ctx: commands.Context, context: contexts.AIContext) -> str:
+        """Creates completion from the context with an API key picked for the invoking guild"""
+        return await utils.create_completion_result_from_context(self.bot.loop, context, pool=self.bot.key_pool,
+                                                                 guild_id=ctx.guild.id if ctx.guild else None)
+
+    async def complete_chunk(self, context: contexts.AIContext, guild_id: Optional[int]) -> Tuple[str, bool]:
+        """Creates completion from the context and returns its text and if it was cut at the token limit"""
+        result = await utils.create_completion_from_context(self.bot.loop, context, pool=self.bot.key_pool,
+                                                            guild_id=guild_id)
+        choice = result["choices"][0]
+        return choice["text"], choice.get("finish_reason") == "length"
+
+    async def send_continuable(self, ctx: commands.Context, context: contexts.AIContext, prefix: str = "```"):
+        """Sends the first chunk of a long output with a control to continue it if there's more to generate"""
+        guild_id = ctx.guild.id if ctx.guild else None
+        context.max_tokens = min(context.max_tokens, self.chunk_tokens)
+        async with ctx.typing():
+            text, truncated = await self.complete_chunk(context, guild_id)
+            message = await self.bot.outbound.send(ctx.channel, prefix + text[:1997 - len(prefix)] + "```")
+        if truncated:
+            self.continuations.add(message.id, Continuation(ctx.author.id, guild_id, context, text))
+            await self.bot.outbound.add_reactions(message, CONTINUE_EMOJI)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        """Generates the next chunk of a long output when its author reacts to continue"""
+        if str(payload.emoji) != CONTINUE_EMOJI or self.bot.shutting_down:
+            return
+        session = self.continuations.get(payload.message_id)
+        if session is None or session.author_id != payload.user_id:
+            return
+        channel = self.bot.get_channel(payload.channel_id) or await self.bot.fetch_channel(payload.channel_id)
+
+        # Chunks share the cooldown of the commands
+        if not await self.bot.is_owner(discord.Object(payload.user_id)):
+            try:
+                self.check_user_cooldown(payload.user_id, "continue", session.guild_id)
+            except commands.CommandOnCooldown as e:
+                return await utils.raise_failure(channel,
+                                                 f"You have to wait `{int(e.retry_after)}` seconds to continue")
+        self.continuations.pop(payload.message_id)
+
+        # Deleting the message cancels the chunk like it does for commands
+        record = inflight.track(channel.id)
+        self.bot.in_flight[payload.message_id] = record
+        try:
+            async with channel.typing():
+                text, truncated = await self.complete_chunk(session.next_context(self.continuations.max_chars),
+                                                            session.guild_id)
+                message = await self.bot.outbound.send(channel, "```" + text[:1993] + "```")
+        except (utils.APIUnavailable, openai.error.OpenAIError, asyncio.TimeoutError, discord.HTTPException) as e:
+            # Keep the session so the author can react again to retry
+            self.continuations.add(payload.message_id, session)
+            if isinstance(e, utils.APIUnavailable):
+                await utils.raise_failure(channel, str(e))
+            elif isinstance(e, openai.error.RateLimitError):
+                await utils.raise_failure(channel, "The AI is too busy right now, try again later")
+            elif isinstance(e, openai.error.APIConnectionError):
+                await utils.raise_failure(channel, e.user_message)
+            elif isinstance(e, discord.HTTPException):
+                log.warning("Continuation couldn't be sent", extra={"guild": session.guild_id, "user": payload.user_id})
+            else:
+                log.exception("Continuation failed", extra={"guild": session.guild_id, "user": payload.user_id})
+                await utils.raise_failure(channel, "The AI failed to respond, try again later")
+            return
+        finally:
+            if self.bot.in_flight.get(payload.message_id) is record:
+                del self.bot.in_flight[payload.message_id]
+
+        self.bot.metrics.increment("continuations.chunks")
+        session.extend(text, self.continuations.max_chars)
+        if truncated and session.chunks < self.max_chunks:
+            self.continuations.add(message.id, session)
+            await self.bot.outbound.add_reactions(message, CONTINUE_EMOJI)
+
+        with suppress(discord.HTTPException):
+            await self.bot.http.remove_own_reaction(payload.channel_id, payload.message_id, CONTINUE_EMOJI)
+
+    @tracing.traced()
     async def check_cooldown(self, ctx: commands.context):
         """Checks the user command cooldown in context"""
         if not self.enable_cooldown:
             return True
 
-        now = datetime.utcnow()
-
         # Exclude bot owner from all cooldowns
-        if await checks.is_owner(ctx):
+        with suppress(utils.OwnerOnly):
+            return await checks.is_owner(ctx)
+
+        return self.check_user_cooldown(ctx.author.id, str(ctx.command), ctx.guild.id if ctx.guild else None)
+
+    def check_user_cooldown(self, user_id: int, command: str, guild_id: Optional[int]):
+        """Checks the cooldown of the user and starts a new one if it's over"""
+        if not self.enable_cooldown:
             return True
 
+        now = datetime.utcnow()
+
         # Return if author never been in cooldown before
-        last_time: datetime = self.invocation_times.get(ctx.author.id, None)
+        last_time: datetime = self.invocation_times.get(user_id, None)
         if not last_time:
-            self.invocation_times[ctx.author.id] = now
+            self.invocation_times[user_id] = now
             return True
 
         cooldown_end = last_time + timedelta(seconds=self.cooldown)
 
         # Return if time has passed since cooldown end
         if cooldown_end < now:
-            self.invocation_times[ctx.author.id] = now
+            self.invocation_times[user_id] = now
             return True
 
         retry_after = (cooldown_end - now).total_seconds()
-        print((cooldown_end - now))
+        log.info("Command on cooldown", extra={
+            "command": command, "guild": guild_id, "user": user_id, "sample": 0.1
+        })
 
         raise commands.CommandOnCooldown(None, retry_after)
 
@@ -61,11 +209,60 @@ class Questions(MuffinCog):
         # Check for cooldown
         await self.check_cooldown(ctx)
 
+        # Reuse the answer if a similar question was answered recently, unless the guild has its own persona or
+        # the question may refer to an earlier one
+        guild_id = ctx.guild.id if ctx.guild else None
+        history = self.conversations.history(ctx.channel.id)
+        reuse = (not self.conversations.is_active(ctx.channel.id)
+                 and not contexts.store.has_override(self.bot.config.data_path, "helpbot", guild_id))
+        answer = self.answered_questions.lookup(question, guild_id) if reuse else None
+        if answer is not None:
+            return await self.bot.outbound.send(ctx.channel, answer)
+
         # Create question context and contact API
-        context = contexts.create_question_context(self.bot.config.data_path, question, self.bot.user.display_name)
+        context = contexts.create_question_context(self.bot.config.data_path, question, self.bot.user.display_name,
+                                                   guild_id, history)
         async with ctx.typing():
-            result = await utils.create_completion_result_from_context(self.bot.loop, context)
-            await ctx.send(result)
+            result = await self.complete_context(ctx, context)
+            await self.bot.outbound.send(ctx.channel, result)
+        self.conversations.add(ctx.channel.id, question, result)
+        if reuse:
+            self.answered_questions.add(question, result)
+
+    @commands.check(checks.is_whitelisted)
+    @commands.command(name="conversation", aliases=["conv"])
+    async def conversation(self, ctx: commands.Context, enabled: bool):
+        """Turns conversation mode of the channel on or off. In conversation mode `ask` remembers recent questions"""
+        if enabled:
+            self.conversations.start(ctx.channel.id)
+            minutes = int(self.conversations.idle_timeout // 60)
+            return await utils.raise_success(ctx.channel, f"Conversation started, it ends after {minutes} minutes "
+                                                          f"without questions")
+        self.conversations.stop(ctx.channel.id)
+        await utils.raise_success(ctx.channel, "Conversation ended")
+
+    @commands.check(checks.is_owner)
+    @commands.command(name="ask_stats", hidden=True)
+    async def ask_stats(self, ctx: commands.Context):
+        """Shows how often `ask` reused answers of near-duplicate questions. Only usable by owners"""
+        index = self.answered_questions
+        embed = discord.Embed(title="Reused Answers",
+                              description=f"`{len(index.entries)}/{index.capacity}` answers stored",
+                              colour=discord.Colour.blurple())
+        busiest = sorted(index.stats.items(), key=lambda item: item[1][1], reverse=True)[:10]
+        for guild_id, (hits, lookups) in busiest:
+            guild = self.bot.get_guild(guild_id) if guild_id else None
+            name = guild.name if guild else str(guild_id or "DMs")
+            embed.add_field(name=name, value=f"`{hits}/{lookups}` (`{index.hit_rate(guild_id):.0%}`)")
+        await self.bot.outbound.send(ctx.channel, embed=embed)
+
+    @commands.guild_only()
+    @commands.check(checks.is_admin)
+    @commands.command(name="reload_contexts")
+    async def reload_contexts(self, ctx: commands.Context):
+        """Reloads the context overrides of this server after they were edited. Only usable by admins"""
+        contexts.store.invalidate(ctx.guild.id)
+        await utils.raise_success(ctx.channel, "Context overrides of this server will be reloaded on next use")
 
     @commands.check(checks.is_whitelisted)
     @commands.check(checks.is_appropriate)
@@ -78,8 +275,9 @@ class Questions(MuffinCog):
         # Send the text to API without a context
         async with ctx.typing():
             result = await utils.create_completion_result(self.bot.loop, prompt=text, temperature=.8, max_tokens=64,
-                                                          stop="\n", engine="davinci")
-            await ctx.send(text + result)
+                                                          stop="\n", engine="davinci", pool=self.bot.key_pool,
+                                                          guild_id=ctx.guild.id if ctx.guild else None)
+            await self.bot.outbound.send(ctx.channel, text + result)
 
     @commands.check(checks.is_whitelisted)
     @commands.check(checks.is_appropriate)
@@ -92,8 +290,10 @@ class Questions(MuffinCog):
         # Send the text to API without a context
         async with ctx.typing():
             result = await utils.create_completion_result(self.bot.loop, prompt=text, temperature=.8,
-                                                          max_tokens=max_tokens, stop="\n", engine="davinci")
-            await ctx.send(text + result)
+                                                          max_tokens=max_tokens, stop="\n", engine="davinci",
+                                                          pool=self.bot.key_pool,
+                                                          guild_id=ctx.guild.id if ctx.guild else None)
+            await self.bot.outbound.send(ctx.channel, text + result)
 
     @commands.check(checks.is_whitelisted)
     @commands.check(checks.is_appropriate)
@@ -104,10 +304,9 @@ class Questions(MuffinCog):
         await self.check_cooldown(ctx)
 
         # Create instruction context and contact API
-        context = contexts.create_instruction_context(self.bot.config.data_path, instruction=prompt)
-        async with ctx.typing():
-            result = await utils.create_completion_result_from_context(self.bot.loop, context)
-            await ctx.send("```"+result[:1993]+"```")
+        context = contexts.create_instruction_context(self.bot.config.data_path, instruction=prompt,
+                                                      guild_id=ctx.guild.id if ctx.guild else None)
+        await self.send_continuable(ctx, context)
 
     @commands.check(checks.is_whitelisted)
     @commands.check(checks.is_appropriate)
@@ -123,12 +322,11 @@ class Questions(MuffinCog):
         await self.check_cooldown(ctx)
 
         # Create instruction context and contact API
-        context = contexts.create_instruction_context(self.bot.config.data_path, instruction=prompt)
+        context = contexts.create_instruction_context(self.bot.config.data_path, instruction=prompt,
+                                                      guild_id=ctx.guild.id if ctx.guild else None)
         # Set custom `max_tokens` and `temperature`
         context.max_tokens, context.temperature = max_tokens, temperature
-        async with ctx.typing():
-            result = await utils.create_completion_result_from_context(self.bot.loop, context)
-            await ctx.send("```" + result[:1993] + "```")
+        await self.send_continuable(ctx, context)
 
     @commands.check(checks.is_whitelisted)
     @commands.check(checks.is_appropriate)
@@ -143,12 +341,11 @@ class Questions(MuffinCog):
         await self.check_cooldown(ctx)
 
         # Create a new story context and contact API
-        context = contexts.create_story_context(self.bot.config.data_path, text=prompt)
+        context = contexts.create_story_context(self.bot.config.data_path, text=prompt,
+                                                guild_id=ctx.guild.id if ctx.guild else None)
         # Set custom `max_tokens`
         context.max_tokens = max_tokens
-        async with ctx.typing():
-            result = await utils.create_completion_result_from_context(self.bot.loop, context)
-            await ctx.send("```" + result[:1993] + "```")
+        await self.send_continuable(ctx, context)
 
     @commands.check(checks.is_whitelisted)
     @commands.check(checks.is_appropriate)
@@ -158,18 +355,17 @@ class Questions(MuffinCog):
         """Give a prompt to create a list of items"""
         # Limit tokens
         if 0 >= max_tokens > 256:
-            return await ctx.send("Max tokens argument has to be between 0 and 256")
+            return await self.bot.outbound.send(ctx.channel, "Max tokens argument has to be between 0 and 256")
 
         # Check for cooldown
         await self.check_cooldown(ctx)
 
         # Create new list context and contact API
-        context = contexts.create_list_context(self.bot.config.data_path, text=prompt)
+        context = contexts.create_list_context(self.bot.config.data_path, text=prompt,
+                                               guild_id=ctx.guild.id if ctx.guild else None)
         # Set custom `max_tokens` and `temperature`
         context.max_tokens, context.temperature = max_tokens, temperature
-        async with ctx.typing():
-            result = await utils.create_completion_result_from_context(self.bot.loop, context)
-            await ctx.send("```1." + result[:1991] + "```")
+        await self.send_continuable(ctx, context, prefix="```1.")
 
     @commands.check(checks.is_whitelisted)
     @commands.check(checks.is_appropriate)
@@ -180,10 +376,11 @@ class Questions(MuffinCog):
         await self.check_cooldown(ctx)
 
         # Create new translation context and contact API
-        context = contexts.create_translation_context(self.bot.config.data_path, text=text)
+        context = contexts.create_translation_context(self.bot.config.data_path, text=text,
+                                                      guild_id=ctx.guild.id if ctx.guild else None)
         async with ctx.typing():
-            result = await utils.create_completion_result_from_context(self.bot.loop, context)
-            await ctx.send("```"+result[:1993]+"```")
+            result = await self.complete_context(ctx, context)
+            await self.bot.outbound.send(ctx.channel, "```"+result[:1993]+"```")
 
     @commands.check(checks.is_whitelisted)
     @commands.check(checks.is_appropriate)
@@ -197,11 +394,11 @@ class Questions(MuffinCog):
         # Check for cooldown
         await self.check_cooldown(ctx)
 
-        # Create new classification context and contact API
+        # Create new classification context and contact API. Like the filter, it ignores guild overrides
         context = contexts.create_filter_context(self.bot.config.data_path, content=text)
         async with ctx.typing():
-            result = await utils.create_completion_result_from_context(self.bot.loop, context)
-            await ctx.send(str(result))
+            result = await self.complete_context(ctx, context)
+            await self.bot.outbound.send(ctx.channel, str(result))
 
 
 def setup(bot: MuffinBot):
@@ -2,6 +2,7 @@ import discord
 from discord.ext import commands
 
 import utils
+from utils import tracing
 from classes import MuffinBot
 
 
@@ -9,6 +10,7 @@ bot = MuffinBot(config_filename="config.json")
 
 
 @bot.check
+@tracing.traced()
 async def globally_block_dms(ctx: commands.Context):
     """Globally blocks all DMs from everyone except the API bot owner"""
     app: discord.AppInfo = await bot.application_info()
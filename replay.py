@@ -0,0 +1,193 @@
+"""Replays recorded command traffic against a local stub API and reports latency and API calls per command
+
+Usage: python replay.py TRAFFIC_FILE [--speed N] [--api-latency SECONDS] [--config config.json]
+
+Set `RECORD_PATH` in the config to record traffic. Commands are invoked through the real cogs and checks, but
+OpenAI requests and Discord sends never leave the process.
+"""
+import time
+import random
+import asyncio
+import argparse
+from types import SimpleNamespace
+from collections import defaultdict
+
+import openai
+
+from classes import MuffinBot
+from utils.traffic import read_traffic
+from utils.tracing import Tracer
+
+# Words the replayed prompts are made of, recordings don't keep the text
+FILLER_WORDS = ["what", "is", "the", "story", "about", "a", "dog", "write", "please", "how", "would", "you"]
+
+
+class StubCompletion:
+    """Stands in for `openai.Completion.create`, sleeping for a jittered latency in the executor thread"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def __call__(self, engine: str, prompt: str, max_tokens: int, **kwargs):
+        time.sleep(random.uniform(0.5, 1.5) * self.latency * (1 + max_tokens / 256))
+        text = "0" if engine.startswith("content-filter") else " lorem" * max_tokens
+        return {"choices": [{"text": text}], "usage": {"total_tokens": max_tokens}}
+
+
+class StubChannel:
+    def __init__(self, channel_id: int, guild):
+        self.id = channel_id
+        self.guild = guild
+        self._state = SimpleNamespace(http=SimpleNamespace(send_typing=self._noop), loop=asyncio.get_event_loop())
+
+    async def _noop(self, *args, **kwargs):
+        pass
+
+    async def _get_channel(self):
+        return self
+
+    async def send(self, content=None, **kwargs):
+        return StubMessage(random.getrandbits(63), content or "", self, None)
+
+    async def trigger_typing(self):
+        pass
+
+
+class StubMessage:
+    def __init__(self, message_id: int, content: str, channel: StubChannel, author):
+        self.id = message_id
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self._state = channel._state
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def remove_reaction(self, emoji, member):
+        pass
+
+    async def clear_reactions(self):
+        pass
+
+
+class DirectOutbound:
+    """Stands in for `Outbound`, sending right away so the report doesn't measure our own rate limiting"""
+
+    async def send(self, channel, content=None, **kwargs):
+        return await channel.send(content, **kwargs)
+
+    async def edit(self, message, **kwargs):
+        return await message.edit(**kwargs)
+
+    async def add_reactions(self, message, *emojis):
+        for emoji in emojis:
+            await message.add_reaction(emoji)
+
+    async def remove_reactions(self, message, member, *emojis):
+        for emoji in emojis:
+            await message.remove_reaction(emoji, member)
+
+    async def clear_reactions(self, message):
+        await message.clear_reactions()
+
+    async def drain(self, timeout: float):
+        pass
+
+    def cancel_channel(self, channel_id: int):
+        pass
+
+
+def create_content(prefix: str, record) -> str:
+    """Rebuilds a command message with the recorded numeric arguments and the same amount of text"""
+    words, length = [], 0
+    while length < record.chars:
+        word = random.choice(FILLER_WORDS)
+        words.append(word)
+        length += len(word)
+    return " ".join([f"{prefix}{record.command}", *map(str, record.numbers), *words])
+
+
+async def replay(bot: MuffinBot, path: str, speed: float):
+    prefix = bot.command_prefix if isinstance(bot.command_prefix, str) else bot.command_prefix[0]
+    author = SimpleNamespace(id=1, bot=False, mention="<@1>", name="replay", display_name="replay",
+                             guild_permissions=SimpleNamespace(administrator=False))
+    owner = SimpleNamespace(id=0)
+    bot.config.whitelist = [author.id]
+    bot._connection.user = SimpleNamespace(id=2, name="MuffinBot", display_name="MuffinBot")
+
+    async def application_info():
+        return SimpleNamespace(owner=owner)
+    bot.application_info = application_info
+
+    # Recorded users are unknown, so cooldowns can't be replayed faithfully
+    questions = bot.get_cog("Questions")
+    if questions is not None:
+        questions.enable_cooldown = False
+
+    records = list(read_traffic(path))
+    if not records:
+        return
+    channels = {}
+    tasks = []
+    start, first = time.monotonic(), records[0].time
+    for record in records:
+        delay = (record.time - first) / speed - (time.monotonic() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        guild = SimpleNamespace(id=int(record.guild, 16), name=record.guild) if record.guild else None
+        if record.guild not in channels:
+            channels[record.guild] = StubChannel(len(channels) + 1, guild)
+        message = StubMessage(random.getrandbits(63), create_content(prefix, record), channels[record.guild], author)
+        ctx = await bot.get_context(message)
+        tasks.append(asyncio.ensure_future(bot.invoke(ctx)))
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def report(tracer: Tracer):
+    durations, api_calls = defaultdict(list), defaultdict(int)
+    for root in tracer.traces:
+        durations[root.name].append(root.duration)
+        stack = list(root.children)
+        while stack:
+            span = stack.pop()
+            if span.name == "openai.completion":
+                api_calls[root.name] += 1
+            stack.extend(span.children)
+
+    print(f"{'command':<24}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'api/cmd':>10}")
+    for name, values in sorted(durations.items()):
+        values.sort()
+        p50, p95, p99 = (values[min(int(len(values) * p), len(values) - 1)] * 1000 for p in (0.5, 0.95, 0.99))
+        print(f"{name:<24}{len(values):>8}{p50:>8.0f}ms{p95:>8.0f}ms{p99:>8.0f}ms"
+              f"{api_calls[name] / len(values):>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded command traffic against a stub API")
+    parser.add_argument("path", help="Traffic file written by the recorder")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier")
+    parser.add_argument("--api-latency", type=float, default=1.0, help="Average stub API latency in seconds")
+    parser.add_argument("--config", default="config.json", help="Bot config file")
+    args = parser.parse_args()
+
+    openai.Completion.create = StubCompletion(args.api_latency)
+    # Start cold, the production caches would answer part of the replay
+    bot = MuffinBot(config_filename=args.config, warm_start=False)
+    bot.recorder = None
+    bot.outbound = DirectOutbound()
+
+    # Keep every trace for the report
+    bot.tracer = Tracer(slow_threshold=0, capacity=None)
+
+    bot.loop.run_until_complete(replay(bot, args.path, args.speed))
+    report(bot.tracer)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from utils.dedup import NearDuplicateIndex
+
+
+def test_paraphrase_reuses_answer():
+    index = NearDuplicateIndex()
+    index.add("how do i use u?", "Mention me or use the ask command")
+    assert index.lookup("How do I use you") == "Mention me or use the ask command"
+
+
+def test_different_place_is_not_a_duplicate():
+    index = NearDuplicateIndex()
+    index.add("What is the capital of Austria?", "Vienna")
+    assert index.lookup("What is the capital of Australia?") is None
+    assert index.lookup("what's the capital of austria") == "Vienna"
+
+
+def test_different_number_is_not_a_duplicate():
+    index = NearDuplicateIndex()
+    index.add("Who was president of the United States in 1955?",
+              "Dwight D. Eisenhower was president of the United States in 1955.")
+    assert index.lookup("Who was president of the United States in 1965?") is None
+    assert index.lookup("Who was president of the United States in 1995?") is None
+
+
+def test_common_words_may_differ():
+    index = NearDuplicateIndex(threshold=0.5)
+    for subject in ["rust", "go", "java", "ruby", "haskell"]:
+        index.add(f"explain the {subject} programming language", subject)
+        index.add(f"describe the {subject} programming language", subject)
+    index.add("explain the python programming language", "python")
+    assert index.lookup("describe the python programming language") == "python"
+    assert index.lookup("describe the kotlin programming language") is None
+
+
+def test_export_and_load():
+    index = NearDuplicateIndex()
+    index.add("What is the capital of Austria?", "Vienna")
+    loaded = NearDuplicateIndex()
+    loaded.load(index.export())
+    assert loaded.lookup("what is the capital of austria") == "Vienna"
+    assert loaded.lookup("What is the capital of Australia?") is None
@@ -1,9 +1,16 @@
 import json
+import asyncio
+import logging
+from typing import Optional
 from contextlib import suppress
 
+import openai
 from discord.ext import commands
 
 import utils
+from utils import prefilter, tracing
+
+log = logging.getLogger("muffin.checks")
 
 
 def get_prompt(ctx: commands.Context) -> str:
@@ -23,6 +30,7 @@ def get_prompt(ctx: commands.Context) -> str:
     return " ".join(words)
 
 
+@tracing.traced()
 async def is_owner(ctx: commands.Context):
     """Checks if the command author is bots API app owner"""
     app = await ctx.bot.application_info()
@@ -33,6 +41,7 @@ async def is_owner(ctx: commands.Context):
     return True
 
 
+@tracing.traced()
 async def is_admin(ctx: commands.Context):
     """Checks if the command author is in guild admin list"""
     if ctx.guild is None:
@@ -58,6 +67,7 @@ async def is_admin(ctx: commands.Context):
     return True
 
 
+@tracing.traced()
 async def is_whitelisted(ctx: commands.Context):
     """Checks if the user was specified as admin in config"""
     # Return true if author is bot owner
@@ -66,14 +76,34 @@ async def is_whitelisted(ctx: commands.Context):
 
     # Check config for user's ID
     if ctx.author.id in ctx.bot.config.whitelist:
-        print(f"User \"{ctx.author}\" authorized for `{ctx.command}` with message \"{ctx.message.content}\"")
+        log.info("Whitelisted user authorized", extra={
+            "command": str(ctx.command), "guild": ctx.guild.id if ctx.guild else None, "user": ctx.author.id,
+            "sample": 0.1
+        })
         return True
 
     raise utils.WhitelistOnly()
 
 
+async def is_text_appropriate(bot, text: str, guild_id: Optional[int] = None) -> bool:
+    """Classifies the text with the local prefilter, and with the OpenAI classification endpoint if the prefilter
+    is unsure. Returns `True` if the text is appropriate
+    """
+    verdict = bot.prefilter.classify(text)
+    bot.metrics.increment(f"prefilter.{verdict}")
+    if verdict != prefilter.UNSURE:
+        return verdict == prefilter.SAFE
+
+    classification = await utils.filter_text(bot, text, guild_id)
+    return classification not in [1, 2]
+
+
+@tracing.traced()
 async def is_appropriate(ctx: commands.Context):
-    """Classifies the text using OpenAI classification endpoint and returns `True` if output is `0`"""
+    """Classifies the text using OpenAI classification endpoint and returns `True` if output is `0`
+
+    The local prefilter decides first, only texts it is unsure about are sent to the API
+    """
     # Return true if author is bot owner
     with suppress(utils.OwnerOnly):
         return await is_owner(ctx)
@@ -83,9 +113,15 @@ async def is_appropriate(ctx: commands.Context):
     if not prompt:
         raise utils.TextInappropriate()
 
-    # Classify the text
-    classification = await utils.filter_text(ctx.bot, prompt)
-    if classification in [1, 2]:
+    # Classify the text without the command name
+    invocation = f"{ctx.prefix}{ctx.invoked_with}"
+    text = prompt[len(invocation):] if prompt.lower().startswith(invocation.lower()) else prompt
+    try:
+        appropriate = await is_text_appropriate(ctx.bot, text, ctx.guild.id if ctx.guild else None)
+    except (openai.error.OpenAIError, asyncio.TimeoutError) as e:
+        # Errors that aren't `CommandError`s raised in checks never reach the error handler
+        raise utils.APIUnavailable("The AI failed to respond, try again later") from e
+    if not appropriate:
         raise utils.TextInappropriate()
 
     return True
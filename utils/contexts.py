@@ -1,63 +1,202 @@
-import json
 import os
-from typing import Union, List
-from dataclasses import dataclass
+import time
+from collections import OrderedDict
+from typing import Union, List, Dict, Optional, Tuple, Sequence
+from dataclasses import dataclass, field
+
+from utils.runtime import json_loads
+from utils.fewshot import ExampleIndex
+from utils.tokens import estimate_tokens
+from utils.memory import Turn
 
 
 @dataclass
 class AIContext:
+    """Everything the API needs to generate text
+
+    `engines` maps acceptable engines to their quality tier (higher is better). Requests are routed to the fastest
+    healthy engine with a tier of at least `min_tier`, `engine` is used if `engines` is not given.
+
+    If the context has `examples`, the `example_count` ones most relevant to the input are added to the prompt as long
+    as the prompt stays within `prompt_budget` tokens.
+    """
     temperature: float
     stop: Union[str, List[str]]
     text: str
     max_tokens: int
     engine: str
-
-
-def get_context(context_name, data_path) -> AIContext:
-    with open(os.path.join(data_path, "contexts", f"{context_name}.json"), "r") as file:
-        data = json.loads(file.read())
+    hedge: bool = False
+    engines: Dict[str, int] = field(default_factory=dict)
+    min_tier: int = 0
+    examples: Optional[ExampleIndex] = None
+    example_count: int = 3
+    prompt_budget: int = 1024
+
+    def __post_init__(self):
+        if not self.engines:
+            self.engines = {self.engine: self.min_tier}
+
+
+class _CachedTemplate:
+    __slots__ = ("data", "mtime", "checked_at")
+
+    def __init__(self, data: Optional[dict], mtime: Optional[float], checked_at: float):
+        self.data = data
+        self.mtime = mtime
+        self.checked_at = checked_at
+
+
+class ContextStore:
+    """Loads context templates with per-guild overrides layered over the global templates
+
+    Overrides are read from `guilds/<guild_id>/contexts/<name>.json` under the data path and only need the keys they
+    change. Templates are loaded the first time they're used. Global templates are always kept, guild overrides, and
+    the lack of one, are kept in an LRU of `capacity` entries. A template is reloaded when its file's mtime changes,
+    which is checked at most every `check_interval` seconds.
+    """
+
+    def __init__(self, capacity: int = 512, check_interval: float = 10.0):
+        self.capacity = capacity
+        self.check_interval = check_interval
+        self.templates: Dict[Tuple[str, Optional[int], str], _CachedTemplate] = {}
+        self.overrides: "OrderedDict[Tuple[str, Optional[int], str], _CachedTemplate]" = OrderedDict()
+
+    @staticmethod
+    def template_path(data_path: str, guild_id: Optional[int], name: str) -> str:
+        if guild_id is None:
+            return os.path.join(data_path, "contexts", f"{name}.json")
+        return os.path.join(data_path, "guilds", str(guild_id), "contexts", f"{name}.json")
+
+    def _load(self, data_path: str, guild_id: Optional[int], name: str) -> Optional[dict]:
+        """Returns the cached template, or `None` if a guild has no override for it"""
+        key = (data_path, guild_id, name)
+        entries = self.templates if guild_id is None else self.overrides
+        now = time.monotonic()
+        entry = entries.get(key)
+        if entry is not None and now - entry.checked_at < self.check_interval:
+            if guild_id is not None:
+                self.overrides.move_to_end(key)
+            return entry.data
+
+        path = self.template_path(data_path, guild_id, name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            # Global templates are required
+            if guild_id is None:
+                raise
+            mtime = None
+
+        if entry is None or entry.mtime != mtime:
+            data = None
+            if mtime is not None:
+                with open(path, "r") as file:
+                    data = json_loads(file.read())
+                if "examples" in data:
+                    data["examples"] = ExampleIndex(data["examples"])
+            entry = _CachedTemplate(data, mtime, now)
+            entries[key] = entry
+        entry.checked_at = now
+        if guild_id is not None:
+            self.overrides.move_to_end(key)
+            while len(self.overrides) > self.capacity:
+                self.overrides.popitem(last=False)
+        return entry.data
+
+    def get(self, data_path: str, name: str, guild_id: Optional[int] = None) -> dict:
+        """Returns the template data with the guild's override applied"""
+        data = dict(self._load(data_path, None, name))
+        if guild_id is not None:
+            data.update(self._load(data_path, guild_id, name) or {})
+        return data
+
+    def has_override(self, data_path: str, name: str, guild_id: Optional[int]) -> bool:
+        return guild_id is not None and self._load(data_path, guild_id, name) is not None
+
+    def invalidate(self, guild_id: Optional[int] = None):
+        """Drops the cached overrides of a guild, or every cached template if no guild is given"""
+        if guild_id is None:
+            self.templates.clear()
+            self.overrides.clear()
+            return
+        for key in [k for k in self.overrides if k[1] == guild_id]:
+            del self.overrides[key]
+
+
+store = ContextStore()
+
+
+def get_context(context_name, data_path, guild_id: Optional[int] = None) -> AIContext:
+    data = store.get(data_path, context_name, guild_id)
     return AIContext(
         data.get("temperature"),
         data.get("stop"),
         data.get("text"),
         data.get("max_tokens"),
-        data.get("engine")
+        data.get("engine"),
+        data.get("hedge", False),
+        dict(data.get("engines", {})),
+        data.get("min_tier", 0),
+        data.get("examples"),
+        data.get("example_count", 3),
+        data.get("prompt_budget", 1024)
     )
 
 
-def create_question_context(data_path: str, question: str, bot_name: str):
-    context = get_context("helpbot", data_path)
-    text = context.text + "\n\nQ: " + question.strip() + "\nA:"
-    context.text = text.format(bot_name=bot_name)
+def create_question_context(data_path: str, question: str, bot_name: str, guild_id: Optional[int] = None,
+                            history: Sequence[Turn] = ()):
+    """Creates the helpbot prompt for the question
+
+    :param history: Earlier turns of the conversation from oldest to newest. The newest ones that fit into the
+    prompt budget are added before the question, examples only get the budget that's left.
+    """
+    context = get_context("helpbot", data_path, guild_id)
+    text = context.text.format(bot_name=bot_name)
+    prompt = "Q: " + question.strip() + "\nA:"
+    budget = context.prompt_budget - estimate_tokens(text) - estimate_tokens(prompt)
+
+    turns = []
+    for turn in reversed(history):
+        if turn.tokens > budget:
+            break
+        turns.append(turn.block)
+        budget -= turn.tokens
+
+    if context.examples is not None:
+        for example in context.examples.select(question, context.example_count, budget):
+            text += "\n\n" + example
+    for block in reversed(turns):
+        text += "\n\n" + block
+    context.text = text + "\n\n" + prompt
     return context
 
 
-def create_instruction_context(data_path: str, instruction: str):
-    context = get_context("instruction", data_path)
+def create_instruction_context(data_path: str, instruction: str, guild_id: Optional[int] = None):
+    context = get_context("instruction", data_path, guild_id)
     context.text = context.text.format(prompt=instruction.strip())
     return context
 
 
-def create_story_context(data_path: str, text: str):
-    context = get_context("write_story", data_path)
+def create_story_context(data_path: str, text: str, guild_id: Optional[int] = None):
+    context = get_context("write_story", data_path, guild_id)
     context.text = context.text.format(prompt=text)
     return context
 
 
-def create_list_context(data_path: str, text: str):
-    context = get_context("write_list", data_path)
+def create_list_context(data_path: str, text: str, guild_id: Optional[int] = None):
+    context = get_context("write_list", data_path, guild_id)
     context.text = context.text.format(prompt=text)
     return context
 
 
-def create_translation_context(data_path: str, text: str):
-    context = get_context("translator", data_path)
+def create_translation_context(data_path: str, text: str, guild_id: Optional[int] = None):
+    context = get_context("translator", data_path, guild_id)
     context.text = context.text.format(prompt=text.strip())
     return context
 
 
-def create_filter_context(data_path: str, content: str):
-    context = get_context("content_classifier", data_path)
+def create_filter_context(data_path: str, content: str, guild_id: Optional[int] = None):
+    context = get_context("content_classifier", data_path, guild_id)
     context.text = context.text.format(content=content)
     return context
 
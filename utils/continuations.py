@@ -0,0 +1,95 @@
+import time
+import dataclasses
+from collections import OrderedDict
+from typing import Optional
+
+from utils.contexts import AIContext
+
+
+class Continuation:
+    """Running context of a long output that's generated a chunk at a time
+
+    Only the prompt the output started from and the tail of the output are kept, the next chunk is generated from
+    their concatenation.
+    """
+    __slots__ = ("author_id", "guild_id", "context", "output", "chunks", "expires_at")
+
+    def __init__(self, author_id: int, guild_id: Optional[int], context: AIContext, output: str):
+        self.author_id = author_id
+        self.guild_id = guild_id
+        self.context = context
+        self.output = output
+        self.chunks = 1
+        self.expires_at = 0.0
+
+    def next_context(self, max_chars: int) -> AIContext:
+        """Returns the context to generate the next chunk with"""
+        return dataclasses.replace(self.context, text=self.context.text + self.output[-max_chars:])
+
+    def extend(self, text: str, max_chars: int):
+        self.output = (self.output + text)[-max_chars:]
+        self.chunks += 1
+
+
+class ContinuationStore:
+    """Continuations by the ID of the message showing their latest chunk
+
+    Continuations expire `ttl` seconds after their latest chunk, and the oldest ones are dropped once there are more
+    than `capacity`.
+    """
+
+    def __init__(self, ttl: float = 900, capacity: int = 1024, max_chars: int = 4000):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.max_chars = max_chars
+        self.sessions: "OrderedDict[int, Continuation]" = OrderedDict()
+
+    def _expire(self, now: float):
+        # Sessions are ordered by expiry since they're always added with the same TTL
+        while self.sessions:
+            message_id, session = next(iter(self.sessions.items()))
+            if session.expires_at > now:
+                break
+            del self.sessions[message_id]
+
+    def add(self, message_id: int, session: Continuation):
+        now = time.monotonic()
+        self._expire(now)
+        session.output = session.output[-self.max_chars:]
+        session.expires_at = now + self.ttl
+        self.sessions[message_id] = session
+        while len(self.sessions) > self.capacity:
+            self.sessions.popitem(last=False)
+
+    def get(self, message_id: int) -> Optional[Continuation]:
+        self._expire(time.monotonic())
+        return self.sessions.get(message_id)
+
+    def pop(self, message_id: int) -> Optional[Continuation]:
+        """Removes and returns the continuation so it's only continued once"""
+        self._expire(time.monotonic())
+        return self.sessions.pop(message_id, None)
+
+    def export(self) -> dict:
+        """Returns the continuations in a JSON serializable form"""
+        now = time.monotonic()
+        sessions = []
+        for message_id, session in self.sessions.items():
+            context = dataclasses.asdict(dataclasses.replace(session.context, examples=None))
+            del context["examples"]
+            sessions.append([message_id, session.author_id, session.guild_id, context, session.output, session.chunks,
+                             session.expires_at - now])
+        return {"sessions": sessions}
+
+    def load(self, data: dict, downtime: float = 0):
+        """Adds continuations returned by `export`, counting `downtime` seconds towards their expiry"""
+        now = time.monotonic()
+        for message_id, author_id, guild_id, context, output, chunks, remaining in data.get("sessions", []):
+            if remaining - downtime <= 0:
+                continue
+            session = Continuation(author_id, guild_id, AIContext(**context), output)
+            session.chunks = chunks
+            session.expires_at = now + remaining - downtime
+            self.sessions[message_id] = session
+        while len(self.sessions) > self.capacity:
+            self.sessions.popitem(last=False)
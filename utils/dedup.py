@@ -0,0 +1,201 @@
+import re
+import time
+import random
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+
+# MinHash signature length and LSH banding. Two questions become candidates if any band of their signatures match
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+
+# A word is common once it's in this share of stored questions, and at least this many of them. Every other word and
+# every number has to be the same in both questions for an answer to be reused, so "capital of Austria" never gets
+# the answer of "capital of Australia" however similar the rest is
+COMMON_FRACTION = 0.1
+COMMON_MIN_COUNT = 5
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(1)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+# Chat shorthand that shouldn't make two questions look different
+_SHORTHANDS = {"u": "you", "r": "are", "ur": "your", "y": "why", "pls": "please", "plz": "please"}
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "to", "of", "in", "on", "at", "for", "and", "or", "do",
+    "does", "did", "i", "me", "my", "you", "your", "it", "its", "that", "this", "what", "whats", "how", "who", "why",
+    "when", "where", "which", "can", "could", "would", "should", "please", "tell", "about"
+}
+
+
+def normalize(text: str) -> str:
+    """Lowercases the text, strips punctuation and expands chat shorthand"""
+    words = _PUNCTUATION.sub("", text.lower()).split()
+    return " ".join(_SHORTHANDS.get(word, word) for word in words)
+
+
+def content_words(normalized: str) -> Tuple[str, ...]:
+    """Returns the words of normalized text without stop words, in order"""
+    return tuple(word for word in normalized.split() if word not in _STOPWORDS)
+
+
+def shingles(words: Tuple[str, ...]) -> Set[int]:
+    """Returns hashed word unigrams and bigrams"""
+    parts = set(words) | {f"{first} {second}" for first, second in zip(words, words[1:])}
+    return {int.from_bytes(hashlib.blake2b(p.encode(), digest_size=8).digest(), "little") for p in parts or {""}}
+
+
+def minhash(hashes: Set[int]) -> Tuple[int, ...]:
+    """Creates the MinHash signature of a shingle set"""
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def similarity(first: Tuple[int, ...], second: Tuple[int, ...]) -> float:
+    """Estimates Jaccard similarity of two signatures"""
+    return sum(1 for a, b in zip(first, second) if a == b) / NUM_PERMUTATIONS
+
+
+class _Entry:
+    __slots__ = ("normalized", "words", "signature", "answer", "created_at")
+
+    def __init__(self, normalized: str, answer: str):
+        self.normalized = normalized
+        self.words = content_words(normalized)
+        self.signature = minhash(shingles(self.words))
+        self.answer = answer
+        self.created_at = time.monotonic()
+
+
+class NearDuplicateIndex:
+    """Bounded index of recently answered questions that finds near-duplicates using MinHash LSH
+
+    Questions match if they're equal after normalization, or if their content words are similar enough and they have
+    the same numbers and uncommon words.
+
+    :param threshold: Minimum estimated Jaccard similarity of content words for a question to count as a duplicate
+    :param capacity: Maximum number of answers to keep, least recently used ones are evicted first
+    :param ttl: Seconds an answer is reused for
+    """
+
+    def __init__(self, threshold: float = 0.8, capacity: int = 1024, ttl: float = 3600):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], Set[int]] = {}
+        self.exact: Dict[str, int] = {}
+        self.document_frequency: Dict[str, int] = {}
+        self.stats: Dict[Optional[int], List[int]] = {}
+        self._next_id = 0
+
+    @staticmethod
+    def _bands(signature: Tuple[int, ...]):
+        for band in range(BANDS):
+            yield band, signature[band * ROWS:(band + 1) * ROWS]
+
+    def _insert(self, entry: _Entry):
+        while len(self.entries) >= self.capacity:
+            self._remove(next(iter(self.entries)))
+        entry_id = self._next_id
+        self._next_id += 1
+        self.entries[entry_id] = entry
+        self.exact[entry.normalized] = entry_id
+        for key in self._bands(entry.signature):
+            self.buckets.setdefault(key, set()).add(entry_id)
+        for word in set(entry.words):
+            self.document_frequency[word] = self.document_frequency.get(word, 0) + 1
+
+    def _remove(self, entry_id: int):
+        entry = self.entries.pop(entry_id)
+        if self.exact.get(entry.normalized) == entry_id:
+            del self.exact[entry.normalized]
+        for key in self._bands(entry.signature):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets[key]
+        for word in set(entry.words):
+            self.document_frequency[word] -= 1
+            if not self.document_frequency[word]:
+                del self.document_frequency[word]
+
+    def _key_words(self, words: Tuple[str, ...]) -> Set[str]:
+        """Returns the numbers and uncommon words, which have to match for questions to be duplicates"""
+        common = max(COMMON_MIN_COUNT, COMMON_FRACTION * len(self.entries))
+        return {word for word in words if word.isdigit() or self.document_frequency.get(word, 0) < common}
+
+    def _expired(self, entry_id: int, now: float) -> bool:
+        if now - self.entries[entry_id].created_at > self.ttl:
+            self._remove(entry_id)
+            return True
+        return False
+
+    def _find(self, normalized: str) -> Optional[int]:
+        now = time.monotonic()
+        entry_id = self.exact.get(normalized)
+        if entry_id is not None and not self._expired(entry_id, now):
+            return entry_id
+
+        words = content_words(normalized)
+        signature = minhash(shingles(words))
+        key_words = self._key_words(words)
+        best_id, best_score = None, self.threshold
+        candidates = set()
+        for key in self._bands(signature):
+            candidates.update(self.buckets.get(key, ()))
+        for entry_id in candidates:
+            if entry_id not in self.entries or self._expired(entry_id, now):
+                continue
+            entry = self.entries[entry_id]
+            score = similarity(signature, entry.signature)
+            if score >= best_score and self._key_words(entry.words) == key_words:
+                best_id, best_score = entry_id, score
+        return best_id
+
+    def lookup(self, question: str, guild_id: Optional[int] = None) -> Optional[str]:
+        """Returns the stored answer of the most similar recent question or `None`"""
+        entry_id = self._find(normalize(question))
+        stats = self.stats.setdefault(guild_id, [0, 0])
+        stats[1] += 1
+        if entry_id is None:
+            return None
+        stats[0] += 1
+        self.entries.move_to_end(entry_id)
+        return self.entries[entry_id].answer
+
+    def add(self, question: str, answer: str):
+        """Stores the answer of a question, evicting the least recently used one if the index is full"""
+        normalized = normalize(question)
+        if normalized in self.exact:
+            self._remove(self.exact[normalized])
+        self._insert(_Entry(normalized, answer))
+
+    def export(self) -> dict:
+        """Returns entries and stats of the index in a JSON serializable form"""
+        now = time.monotonic()
+        return {
+            "entries": [[e.normalized, e.answer, now - e.created_at] for e in self.entries.values()],
+            "stats": [[guild_id, hits, lookups] for guild_id, (hits, lookups) in self.stats.items()]
+        }
+
+    def load(self, data: dict, downtime: float = 0):
+        """Adds entries and stats returned by `export`, counting `downtime` seconds towards the age of entries"""
+        now = time.monotonic()
+        for normalized, answer, age in data.get("entries", []):
+            if age + downtime > self.ttl:
+                continue
+            entry = _Entry(normalized, answer)
+            entry.created_at = now - age - downtime
+            self._insert(entry)
+        for guild_id, hits, lookups in data.get("stats", []):
+            stats = self.stats.setdefault(guild_id, [0, 0])
+            stats[0] += hits
+            stats[1] += lookups
+
+    def hit_rate(self, guild_id: Optional[int] = None) -> float:
+        hits, lookups = self.stats.get(guild_id, (0, 0))
+        return hits / lookups if lookups else 0.0
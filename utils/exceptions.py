@@ -49,3 +49,24 @@ class NoDM(commands.CheckFailure):
 
     def __init__(self, message=None):
         super().__init__(message or 'I don\'t accept DM commands')
+
+
+class ShuttingDown(commands.CheckFailure):
+    """Exception raised when an AI command is invoked while the bot is shutting down
+
+    Inherits from :class:`commands.CheckFailure`
+    """
+
+    def __init__(self, message=None):
+        super().__init__(message or "I'm restarting, try again in a moment")
+
+
+class APIUnavailable(commands.CommandError):
+    """Exception raised when the circuit breaker of an engine is open
+
+    Inherits from :class:`commands.CommandError`
+    """
+
+    def __init__(self, message=None, retry_after: float = 0):
+        self.retry_after = retry_after
+        super().__init__(message or f"The AI is unavailable right now, try again in `{int(retry_after) + 1}` seconds")
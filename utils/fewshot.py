@@ -0,0 +1,67 @@
+import re
+import math
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from utils.tokens import estimate_tokens
+
+# BM25 parameters, `K1` limits how much repeating a term counts and `B` how much long questions are penalized
+K1 = 1.2
+B = 0.75
+
+_WORD = re.compile(r"\w+")
+_STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "to", "of", "in", "on", "for", "and", "or", "do", "does",
+    "did", "i", "you", "it", "that", "this", "what", "how", "who", "why", "when", "where", "which", "can", "me", "my"
+}
+
+
+def terms(text: str) -> List[str]:
+    return [word for word in _WORD.findall(text.lower()) if word not in _STOPWORDS]
+
+
+class ExampleIndex:
+    """Few-shot question and answer examples of a context with a BM25 index over the questions
+
+    The index and token counts of the examples are computed once when the context is loaded.
+    """
+
+    def __init__(self, examples: List[Dict[str, str]]):
+        self.blocks = [f"Q: {example['q'].strip()}\nA: {example['a'].strip()}" for example in examples]
+        self.tokens = [estimate_tokens(block) for block in self.blocks]
+
+        documents = [Counter(terms(example["q"])) for example in examples]
+        self.lengths = [sum(document.values()) for document in documents]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        for index, document in enumerate(documents):
+            for term, frequency in document.items():
+                self.postings.setdefault(term, []).append((index, frequency))
+        self.idf = {term: math.log(1 + (len(documents) - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for term, postings in self.postings.items()}
+
+    def scores(self, question: str) -> List[float]:
+        """Returns the BM25 score of every example for the question"""
+        scores = [0.0] * len(self.blocks)
+        for term in set(terms(question)):
+            for index, frequency in self.postings.get(term, ()):
+                norm = K1 * (1 - B + B * self.lengths[index] / self.average_length)
+                scores[index] += self.idf[term] * frequency * (K1 + 1) / (frequency + norm)
+        return scores
+
+    def select(self, question: str, count: int, budget: int) -> List[str]:
+        """Returns up to `count` of the examples most relevant to the question that fit into `budget` tokens
+
+        Examples come first in the list when nothing matches. The most relevant example is put last so it's
+        closest to the question in the prompt.
+        """
+        scores = self.scores(question)
+        ranking = sorted(range(len(self.blocks)), key=lambda i: scores[i], reverse=True)
+        selected = []
+        for index in ranking:
+            if len(selected) == count:
+                break
+            if self.tokens[index] <= budget:
+                selected.append(index)
+                budget -= self.tokens[index]
+        return [self.blocks[index] for index in reversed(selected)]
@@ -0,0 +1,40 @@
+import asyncio
+from contextvars import ContextVar
+from typing import Optional
+
+
+class InFlight:
+    """AI work started by a message, cancelled if the message or its channel is deleted
+
+    `saved_tokens` counts max tokens of requests that were cancelled before they were sent and `lost_tokens` those of
+    requests that were already running, which are billed anyway.
+    """
+    __slots__ = ("task", "channel_id", "cancelled", "saved_tokens", "lost_tokens")
+
+    def __init__(self, task: asyncio.Task, channel_id: int):
+        self.task = task
+        self.channel_id = channel_id
+        self.cancelled = False
+        self.saved_tokens = 0
+        self.lost_tokens = 0
+
+
+_current: ContextVar[Optional[InFlight]] = ContextVar("in_flight", default=None)
+
+
+def track(channel_id: int) -> InFlight:
+    """Creates the record of the current task and makes it the one API requests are accounted to"""
+    record = InFlight(asyncio.current_task(), channel_id)
+    _current.set(record)
+    return record
+
+
+def account_cancelled(max_tokens: int, sent: bool):
+    """Accounts a request that was cancelled because its message was deleted"""
+    record = _current.get()
+    if record is None or not record.cancelled:
+        return
+    if sent:
+        record.lost_tokens += max_tokens
+    else:
+        record.saved_tokens += max_tokens
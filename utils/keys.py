@@ -0,0 +1,94 @@
+import math
+import time
+from collections import deque
+from typing import Iterable, List, Optional, Tuple
+
+from utils.exceptions import APIUnavailable
+
+
+class APIKey:
+    """An OpenAI API key with its request budget per minute
+
+    :param guilds: IDs of the guilds the key is reserved for, an empty set means any guild can use it
+    :param rpm: Requests per minute, `None` means the key is only limited by the 429s it returns
+    """
+    __slots__ = ("key", "guilds", "rpm", "requests", "cooldown_until", "disabled")
+
+    def __init__(self, key: str, guilds: Iterable[int] = (), rpm: Optional[int] = 60):
+        self.key = key
+        self.guilds = set(guilds)
+        self.rpm = rpm
+        self.requests = deque()
+        self.cooldown_until = 0.0
+        self.disabled = False
+
+    def remaining(self, now: float) -> float:
+        """Returns how many more requests fit into the last minute's budget"""
+        while self.requests and self.requests[0] <= now - 60:
+            self.requests.popleft()
+        if self.rpm is None:
+            return math.inf
+        return self.rpm - len(self.requests)
+
+    def available_at(self, now: float) -> float:
+        """Returns when the key can be used next"""
+        available = max(now, self.cooldown_until)
+        if self.remaining(now) <= 0:
+            available = max(available, self.requests[0] + 60)
+        return available
+
+
+class KeyPool:
+    """Picks an API key per request by remaining rate budget and moves traffic off keys that fail"""
+
+    def __init__(self, keys: List[APIKey]):
+        self.keys = keys
+
+    @classmethod
+    def from_config(cls, ai_config) -> "KeyPool":
+        """Creates the pool from `api_keys` and `api_key` of AI config
+
+        `api_key` is shared by every guild and has no local limit unless `api_key_rpm` is set.
+        """
+        keys = [APIKey(data["key"], data.get("guilds", ()), data.get("rpm", 60)) for data in ai_config.api_keys]
+        if ai_config.api_key:
+            keys.append(APIKey(ai_config.api_key, rpm=ai_config.api_key_rpm))
+        return cls(keys)
+
+    def _candidates(self, guild_id: Optional[int]) -> Tuple[List[APIKey], List[APIKey]]:
+        reserved = [k for k in self.keys if not k.disabled and guild_id is not None and guild_id in k.guilds]
+        shared = [k for k in self.keys if not k.disabled and not k.guilds]
+        return reserved, shared
+
+    def acquire(self, guild_id: Optional[int] = None) -> APIKey:
+        """Returns the usable key with the most remaining budget and counts a request for it
+
+        Keys reserved for the guild are preferred over shared keys.
+        :raises APIUnavailable: If every key is rate limited or disabled
+        """
+        now = time.monotonic()
+        reserved, shared = self._candidates(guild_id)
+
+        for candidates in (reserved, shared):
+            usable = [k for k in candidates if k.cooldown_until <= now and k.remaining(now) > 0]
+            if usable:
+                key = max(usable, key=lambda k: k.remaining(now))
+                key.requests.append(now)
+                return key
+
+        waiting = [k.available_at(now) for k in reserved + shared]
+        raise APIUnavailable(retry_after=min(waiting) - now if waiting else 60)
+
+    def has_other(self, key: APIKey, guild_id: Optional[int] = None) -> bool:
+        """Checks if a key other than `key` can be used for the guild right now"""
+        now = time.monotonic()
+        reserved, shared = self._candidates(guild_id)
+        return any(k is not key and k.cooldown_until <= now and k.remaining(now) > 0 for k in reserved + shared)
+
+    def report_rate_limited(self, key: APIKey, retry_after: Optional[float] = None):
+        """Avoids the key for `retry_after` seconds. Without it, only the failed request's backoff applies"""
+        if retry_after:
+            key.cooldown_until = time.monotonic() + retry_after
+
+    def report_auth_error(self, key: APIKey):
+        key.disabled = True
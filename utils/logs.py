@@ -0,0 +1,92 @@
+import sys
+import copy
+import json
+import queue
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+
+# Structured fields that are copied from `extra` into the JSON output
+FIELDS = ("command", "guild", "user", "engine", "latency", "tokens", "stack")
+
+# Records waiting for the writer thread. When it's full, new records are dropped instead of blocking the loop
+QUEUE_SIZE = 10000
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as single line JSON objects"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a random share of records that were logged with a `sample` rate in `extra`"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample", 1.0)
+        return rate >= 1 or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message and traceback here since args may change before the writer thread gets to them
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(path: Optional[str] = None, level: int = logging.INFO) -> QueueListener:
+    """Sets up `muffin` loggers to write JSON lines to the file at `path` (or stdout) from a background thread
+
+    :returns: Started listener, stop it on shutdown to flush the remaining records
+    """
+    if path:
+        sink = logging.FileHandler(path, encoding="utf-8")
+    else:
+        sink = logging.StreamHandler(sys.stdout)
+    sink.setFormatter(JSONFormatter())
+
+    handler = NonBlockingQueueHandler(queue.Queue(QUEUE_SIZE))
+    handler.addFilter(SamplingFilter())
+
+    logger = logging.getLogger("muffin")
+    logger.setLevel(level)
+    logger.propagate = False
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+
+    listener = QueueListener(handler.queue, sink)
+    listener.start()
+    return listener
@@ -0,0 +1,78 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import Optional
+
+from utils.metrics import Metrics
+
+log = logging.getLogger("muffin.loop")
+
+
+class LoopMonitor:
+    """Measures event loop lag and captures the stack of callbacks that block the loop
+
+    A callback scheduled every `interval` seconds records how late it runs as `loop.lag`. A watchdog thread checks
+    that callback's heartbeat and, if the loop hasn't run it for `slow_threshold` seconds past its schedule, logs the
+    stack of the loop thread while it's still blocked.
+
+    :param interval: Seconds between lag samples
+    :param slow_threshold: Seconds a callback can block the loop before its stack is captured
+    """
+
+    def __init__(self, metrics: Metrics, interval: float = 0.5, slow_threshold: float = 0.25):
+        self.metrics = metrics
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.expected = 0.0
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """Starts monitoring the running loop, must be called from the loop thread"""
+        if self.handle is not None:
+            return
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.stopped.clear()
+        self._schedule()
+        self.watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _schedule(self):
+        self.expected = time.monotonic() + self.interval
+        self.handle = self.loop.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        lag = max(0.0, time.monotonic() - self.expected)
+        self.metrics.observe("loop.lag", lag)
+        self._schedule()
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.slow_threshold / 2):
+            expected = self.expected
+            blocked = time.monotonic() - expected
+            if blocked < self.slow_threshold or reported == expected:
+                continue
+
+            # Report each stall once, while the blocking callback is still on the stack
+            reported = expected
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "Unknown"
+            self.metrics.increment("loop.slow_callbacks")
+            log.warning(f"Event loop blocked for over {blocked:.3f}s", extra={"latency": blocked, "stack": stack})
+
+    def percentile(self, p: float) -> Optional[float]:
+        return self.metrics.percentile("loop.lag", p)
@@ -0,0 +1,97 @@
+import time
+from collections import OrderedDict, deque
+from typing import List
+
+from utils.tokens import estimate_tokens
+
+
+class Turn:
+    """A question and its answer with the token count of their prompt block, computed once"""
+    __slots__ = ("question", "answer", "block", "tokens")
+
+    def __init__(self, question: str, answer: str):
+        self.question = question
+        self.answer = answer
+        self.block = f"Q: {question}\nA: {answer}"
+        self.tokens = estimate_tokens(self.block)
+
+
+class Conversation:
+    __slots__ = ("turns", "last_used")
+
+    def __init__(self, max_turns: int):
+        self.turns = deque(maxlen=max_turns)
+        self.last_used = time.monotonic()
+
+
+class ConversationMemory:
+    """Recent turns of channels that are in conversation mode
+
+    Every channel keeps its last `max_turns` turns, each cut to `max_chars` characters, and at most `capacity`
+    channels are kept, so memory use is capped. Conversations end after `idle_timeout` seconds without a question.
+    """
+
+    def __init__(self, max_turns: int = 8, max_chars: int = 500, capacity: int = 1000, idle_timeout: float = 1800):
+        self.max_turns = max_turns
+        self.max_chars = max_chars
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        self.conversations: "OrderedDict[int, Conversation]" = OrderedDict()
+
+    def _evict(self, now: float):
+        # Conversations are ordered by when they were last used
+        while self.conversations:
+            channel_id, conversation = next(iter(self.conversations.items()))
+            if now - conversation.last_used < self.idle_timeout and len(self.conversations) <= self.capacity:
+                break
+            del self.conversations[channel_id]
+
+    def start(self, channel_id: int):
+        if channel_id not in self.conversations:
+            self.conversations[channel_id] = Conversation(self.max_turns)
+        self.conversations[channel_id].last_used = time.monotonic()
+        self.conversations.move_to_end(channel_id)
+        self._evict(time.monotonic())
+
+    def stop(self, channel_id: int):
+        self.conversations.pop(channel_id, None)
+
+    def is_active(self, channel_id: int) -> bool:
+        self._evict(time.monotonic())
+        return channel_id in self.conversations
+
+    def history(self, channel_id: int) -> List[Turn]:
+        """Returns the turns of the channel's conversation from oldest to newest"""
+        self._evict(time.monotonic())
+        conversation = self.conversations.get(channel_id)
+        return list(conversation.turns) if conversation else []
+
+    def add(self, channel_id: int, question: str, answer: str):
+        """Remembers the turn if the channel is in a conversation"""
+        conversation = self.conversations.get(channel_id)
+        if conversation is None:
+            return
+        conversation.turns.append(Turn(question.strip()[:self.max_chars], answer.strip()[:self.max_chars]))
+        conversation.last_used = time.monotonic()
+        self.conversations.move_to_end(channel_id)
+
+    def export(self) -> dict:
+        """Returns the conversations in a JSON serializable form"""
+        now = time.monotonic()
+        return {
+            "conversations": [[channel_id, [[turn.question, turn.answer] for turn in conversation.turns],
+                               now - conversation.last_used]
+                              for channel_id, conversation in self.conversations.items()]
+        }
+
+    def load(self, data: dict, downtime: float = 0):
+        """Adds conversations returned by `export`, counting `downtime` seconds as idle time"""
+        now = time.monotonic()
+        for channel_id, turns, idle in data.get("conversations", []):
+            if idle + downtime >= self.idle_timeout:
+                continue
+            conversation = Conversation(self.max_turns)
+            conversation.turns.extend(Turn(question, answer) for question, answer in turns)
+            conversation.last_used = now - idle - downtime
+            self.conversations[channel_id] = conversation
+        self._evict(now)
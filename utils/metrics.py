@@ -0,0 +1,36 @@
+from collections import Counter, deque
+from typing import Dict, Optional
+
+
+class Metrics:
+    """In-memory counters, gauges and rolling observations of the bot"""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.counters = Counter()
+        self.gauges: Dict[str, float] = {}
+        self.observations: Dict[str, deque] = {}
+
+    def increment(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def set(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        """Records a value, only the last `window` values of a metric are kept"""
+        if name not in self.observations:
+            self.observations[name] = deque(maxlen=self.window)
+        self.observations[name].append(value)
+
+    def percentile(self, name: str, p: float) -> Optional[float]:
+        values = self.observations.get(name)
+        if not values:
+            return None
+        ordered = sorted(values)
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+    def rate(self, name: str, prefix: str) -> float:
+        """Returns the share of counter `name` among all counters starting with `prefix`"""
+        total = sum(value for key, value in self.counters.items() if key.startswith(prefix))
+        return self.counters[name] / total if total else 0.0
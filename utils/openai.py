@@ -1,52 +1,353 @@
+import time
+import random
+import asyncio
+import logging
 from asyncio import BaseEventLoop
-from typing import Union, List
+from collections import deque
+from typing import Union, List, Dict, Optional
 
 import openai
 
-from utils import contexts
+from utils import contexts, tracing, inflight
+from utils.exceptions import APIUnavailable
+from utils.keys import KeyPool
 
+log = logging.getLogger("muffin.openai")
 
-def setup_openai(api_key: str):
-    openai.api_key = api_key
+# Retry configuration for rate-limit and 5xx errors
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
 
+# Seconds to wait for a single API request before giving up on it
+REQUEST_TIMEOUT = 30.0
 
-def sync_create_completion(prompt: str, temperature: float,
-                           max_tokens: int, stop: Union[str, List[str]], engine="davinci") -> openai.Completion:
-    """Creates completion using OpenAI API"""
+# Hedged requests are sent once the first one takes longer than this latency percentile
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+
+# Circuit breaker configuration
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+
+# Engines failing more than this share of requests in the last `ROUTER_ERROR_WINDOW` seconds are avoided by the router
+ROUTER_MAX_ERROR_RATE = 0.2
+ROUTER_ERROR_WINDOW = 60.0
+
+# Seconds latency samples are kept for. Once an engine that lost on latency has no recent samples, it's tried again
+LATENCY_WINDOW = 300.0
+
+
+class EngineStats:
+    """Keeps rolling windows of recent request latencies and outcomes of an engine"""
+    __slots__ = ("samples", "outcomes")
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+        self.outcomes = deque(maxlen=size)
+
+    def add(self, latency: float):
+        self.samples.append((time.monotonic(), latency))
+
+    def add_outcome(self, success: bool):
+        self.outcomes.append((time.monotonic(), success))
+
+    def percentile(self, p: float, min_samples: int = HEDGE_MIN_SAMPLES) -> Optional[float]:
+        """Returns the latency at given percentile of the last `LATENCY_WINDOW` seconds or `None` if there are not
+        enough samples
+        """
+        since = time.monotonic() - LATENCY_WINDOW
+        while self.samples and self.samples[0][0] < since:
+            self.samples.popleft()
+        if not self.samples or len(self.samples) < min_samples:
+            return None
+        ordered = sorted(latency for _, latency in self.samples)
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+    def error_rate(self) -> float:
+        """Returns the share of failed requests in the last `ROUTER_ERROR_WINDOW` seconds"""
+        since = time.monotonic() - ROUTER_ERROR_WINDOW
+        recent = [success for timestamp, success in self.outcomes if timestamp >= since]
+        if not recent:
+            return 0.0
+        return 1 - sum(recent) / len(recent)
+
+
+class CircuitBreaker:
+    """Fails fast while an engine keeps failing and lets a single probe through after `reset_timeout`"""
+    __slots__ = ("failure_threshold", "reset_timeout", "failures", "opened_at", "probing")
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Returns `True` if a request may be sent to the engine"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_engine_stats: Dict[str, EngineStats] = {}
+
+
+def get_breaker(engine: str) -> CircuitBreaker:
+    if engine not in _breakers:
+        _breakers[engine] = CircuitBreaker()
+    return _breakers[engine]
+
+
+def get_engine_stats(engine: str) -> EngineStats:
+    if engine not in _engine_stats:
+        _engine_stats[engine] = EngineStats()
+    return _engine_stats[engine]
+
+
+def route_engine(context: contexts.AIContext) -> str:
+    """Picks the engine with the lowest median latency among the healthy engines that meet the context's minimum
+    tier. Engines without recent latency samples are tried first, so an engine that was slow gets traffic again once
+    its samples age out. The context's own engine is used if none are healthy
+    """
+    candidates = [engine for engine, tier in context.engines.items() if tier >= context.min_tier]
+    best_engine, best_latency = context.engine, None
+    for engine in candidates:
+        if get_breaker(engine).state == "open":
+            continue
+        stats = get_engine_stats(engine)
+        if stats.error_rate() > ROUTER_MAX_ERROR_RATE:
+            continue
+        latency = stats.percentile(0.5, min_samples=1) or 0.0
+        if best_latency is None or latency < best_latency:
+            best_engine, best_latency = engine, latency
+    return best_engine
+
+
+def is_retryable(error: Exception) -> bool:
+    """Checks if the error is a rate-limit, timeout or 5xx error that is worth retrying"""
+    if isinstance(error, (openai.error.RateLimitError, openai.error.APIConnectionError, openai.error.Timeout,
+                          openai.error.ServiceUnavailableError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, openai.error.OpenAIError):
+        return (error.http_status or 0) >= 500
+    return False
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def sync_create_completion(prompt: str, temperature: float, max_tokens: int, stop: Union[str, List[str]],
+                           engine="davinci", api_key: Optional[str] = None) -> openai.Completion:
+    """Creates completion using OpenAI API. The HTTP request times out so the executor thread is freed"""
     return openai.Completion.create(engine=engine, prompt=prompt, temperature=temperature, max_tokens=max_tokens,
-                                    stop=stop)
+                                    stop=stop, api_key=api_key, request_timeout=REQUEST_TIMEOUT)
+
+
+async def _timed_completion(loop: BaseEventLoop, prompt: str, temperature: float, max_tokens: int,
+                            stop: Union[str, List[str]], engine: str, api_key: Optional[str]) -> openai.Completion:
+    """Runs a single completion request in the executor and records its latency"""
+    sent = False
+
+    def send():
+        nonlocal sent
+        sent = True
+        return sync_create_completion(prompt, temperature, max_tokens, stop, engine, api_key)
+
+    before = time.monotonic()
+    with tracing.span("openai.completion", engine=engine, max_tokens=max_tokens):
+        try:
+            # Cancelling the future also drops the request if it's still waiting for an executor thread
+            result = await asyncio.wait_for(loop.run_in_executor(None, send), timeout=REQUEST_TIMEOUT)
+        except asyncio.CancelledError:
+            inflight.account_cancelled(max_tokens, sent)
+            raise
+    latency = time.monotonic() - before
+    get_engine_stats(engine).add(latency)
+    log.info("Completion created", extra={
+        "engine": engine, "latency": latency, "tokens": result.get("usage", {}).get("total_tokens")
+    })
+    return result
+
+
+async def _hedged_completion(loop: BaseEventLoop, prompt: str, temperature: float, max_tokens: int,
+                             stop: Union[str, List[str]], engine: str, api_key: Optional[str],
+                             pool: Optional[KeyPool] = None, guild_id: Optional[int] = None) -> openai.Completion:
+    """Sends a duplicate request if the first one is slower than the latency percentile and returns the first result
+
+    The duplicate request takes its own key from the pool, and isn't sent if the pool has no budget left.
+    """
+    threshold = get_engine_stats(engine).percentile(HEDGE_PERCENTILE)
+    first = asyncio.ensure_future(_timed_completion(loop, prompt, temperature, max_tokens, stop, engine, api_key))
+    tasks = [first]
+    try:
+        if threshold is None:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout=threshold)
+        if done:
+            return first.result()
+
+        if pool is not None:
+            try:
+                api_key = pool.acquire(guild_id).key
+            except APIUnavailable:
+                return await first
+        second = asyncio.ensure_future(_timed_completion(loop, prompt, temperature, max_tokens, stop, engine,
+                                                         api_key))
+        tasks.append(second)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+    except asyncio.CancelledError:
+        # `asyncio.wait` doesn't cancel what it waits for, and the requests have to account for their tokens
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+        raise
 
 
 async def create_completion(loop: BaseEventLoop, prompt: str, temperature: float,
-                            max_tokens: int, stop: Union[str, List[str]], engine="davinci") -> openai.Completion:
-    """Asynchronously creates completion using OpenAI API"""
-    return await loop.run_in_executor(None, sync_create_completion, prompt, temperature, max_tokens, stop, engine)
+                            max_tokens: int, stop: Union[str, List[str]], engine="davinci",
+                            hedge: bool = False, pool: Optional[KeyPool] = None,
+                            guild_id: Optional[int] = None) -> openai.Completion:
+    """Asynchronously creates completion using OpenAI API
+
+    Rate-limit and 5xx errors are retried with jittered exponential backoff, and requests fail fast with
+    :class:`APIUnavailable` while the engine's circuit breaker is open.
+
+    :param hedge: Send a duplicate request when the first one is slower than usual. Only use for cheap requests.
+    :param pool: Pool to pick the API key from for each attempt
+    :param guild_id: ID of the guild the request is made for, used to pick keys reserved for it
+    """
+    breaker = get_breaker(engine)
+    stats = get_engine_stats(engine)
+
+    attempt = 0
+    failed = False
+    while True:
+        if not breaker.allow():
+            raise APIUnavailable(retry_after=breaker.retry_after())
+        try:
+            key = pool.acquire(guild_id) if pool is not None else None
+        except APIUnavailable:
+            breaker.probing = False
+            raise
+        try:
+            if hedge:
+                result = await _hedged_completion(loop, prompt, temperature, max_tokens, stop, engine,
+                                                  key.key if key else None, pool, guild_id)
+            else:
+                result = await _timed_completion(loop, prompt, temperature, max_tokens, stop, engine,
+                                                 key.key if key else None)
+        except asyncio.CancelledError:
+            breaker.probing = False
+            raise
+        except Exception as e:
+            # Move traffic off a failing key and try another one right away, the engine isn't at fault
+            if key is not None and isinstance(e, (openai.error.AuthenticationError, openai.error.PermissionError)):
+                breaker.probing = False
+                pool.report_auth_error(key)
+                log.warning("Disabled an API key after an authentication error")
+                continue
+            if key is not None and isinstance(e, openai.error.RateLimitError):
+                retry_after = (getattr(e, "headers", None) or {}).get("retry-after")
+                pool.report_rate_limited(key, float(retry_after) if retry_after else None)
+                # Only switch keys right away if there's another one to switch to, otherwise back off below
+                if pool.has_other(key, guild_id):
+                    breaker.probing = False
+                    continue
+
+            if not is_retryable(e):
+                # Client errors say nothing about the engine's health
+                breaker.probing = False
+                raise
+            # Retries of one request count as a single failure so they can't open the breaker on their own,
+            # unless the attempt was the probe of a half-open breaker
+            if not failed or breaker.probing:
+                breaker.record_failure()
+            failed = True
+            stats.add_outcome(False)
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+            attempt += 1
+        else:
+            breaker.record_success()
+            stats.add_outcome(True)
+            return result
 
 
 async def create_completion_result(loop: BaseEventLoop, prompt: str, temperature: float,
-                                   max_tokens: int, stop: Union[str, List[str]], engine="davinci") -> str:
+                                   max_tokens: int, stop: Union[str, List[str]], engine="davinci",
+                                   pool: Optional[KeyPool] = None, guild_id: Optional[int] = None) -> str:
     """Asynchronously creates completion using OpenAI API and only returns the result text"""
-    result = await create_completion(loop, prompt, temperature, max_tokens, stop, engine)
+    result = await create_completion(loop, prompt, temperature, max_tokens, stop, engine, pool=pool,
+                                     guild_id=guild_id)
     return result["choices"][0]["text"]
 
 
-async def create_completion_from_context(loop: BaseEventLoop, context: contexts.AIContext):
-    """Asynchronously creates completion from given `AIContext`"""
+async def create_completion_from_context(loop: BaseEventLoop, context: contexts.AIContext,
+                                         pool: Optional[KeyPool] = None, guild_id: Optional[int] = None):
+    """Asynchronously creates completion from given `AIContext` using the engine picked by `route_engine`"""
     result = await create_completion(loop, context.text, context.temperature, context.max_tokens, context.stop,
-                                     context.engine)
+                                     route_engine(context), context.hedge, pool=pool, guild_id=guild_id)
     return result
 
 
-async def create_completion_result_from_context(loop: BaseEventLoop, context: contexts.AIContext):
+async def create_completion_result_from_context(loop: BaseEventLoop, context: contexts.AIContext,
+                                                pool: Optional[KeyPool] = None, guild_id: Optional[int] = None):
     """Asynchronously creates completion from given `AIContext` and only returns the resulting text"""
-    result = await create_completion_from_context(loop, context)
+    result = await create_completion_from_context(loop, context, pool=pool, guild_id=guild_id)
     return result["choices"][0]["text"]
 
 
-async def filter_text(bot, content) -> int:
+async def filter_text(bot, content, guild_id: Optional[int] = None) -> int:
     """Filters the text to see if it's appropriate and returns filter value"""
+    # Always classify with the global template so guild overrides can't weaken the filter
     context = contexts.create_filter_context(bot.config.data_path, content)
-    result = await create_completion_from_context(bot.loop, context)
+    result = await create_completion_from_context(bot.loop, context, pool=bot.key_pool, guild_id=guild_id)
     try:
         return int(result["choices"][0]["text"])
     except ValueError:
@@ -0,0 +1,233 @@
+import time
+import asyncio
+from collections import deque
+from typing import Dict, List, Optional, Union
+
+import discord
+
+from utils import tracing
+from utils.metrics import Metrics
+
+
+# Known rate limits of Discord routes as (requests, seconds). These are applied per channel before sending,
+# so we wait on our side instead of getting 429s and relying on discord.py's reactive backoff.
+ROUTE_LIMITS = {
+    "send": (5, 5.0),
+    "edit": (5, 5.0),
+    "reaction": (1, 0.25),
+}
+GLOBAL_LIMIT = (50, 1.0)
+
+# Routes limited together with another route
+SHARED_LIMITS = {
+    "remove_reaction": "reaction",
+    "clear_reactions": "reaction",
+}
+
+# Seconds a channel worker waits for new jobs before exiting
+WORKER_IDLE_TIMEOUT = 60.0
+
+Messageable = Union[discord.TextChannel, discord.DMChannel]
+
+
+class RateBucket:
+    """Sliding window rate limiter that waits until a request fits into the window"""
+    __slots__ = ("rate", "per", "timestamps")
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.timestamps = deque(maxlen=rate)
+
+    def delay(self) -> float:
+        """Returns how many seconds to wait until the next request is allowed"""
+        if len(self.timestamps) < self.rate:
+            return 0
+        return max(0.0, self.timestamps[0] + self.per - time.monotonic())
+
+    async def acquire(self):
+        delay = self.delay()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+        self.timestamps.append(time.monotonic())
+
+
+class _Job:
+    __slots__ = ("route", "target", "kwargs", "emojis", "waiters", "span", "queued_at")
+
+    def __init__(self, route: str, target, kwargs: Optional[dict] = None, emojis: tuple = ()):
+        self.route = route
+        self.target = target
+        self.kwargs = kwargs or {}
+        self.emojis = emojis
+        self.waiters: List[asyncio.Future] = []
+        self.span = tracing.current_span()
+        self.queued_at = time.monotonic()
+
+    def wait(self) -> asyncio.Future:
+        """Returns a new future of the job's result, so a cancelled caller doesn't cancel the job for the others"""
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.append(future)
+        return future
+
+    def cancelled(self) -> bool:
+        return all(future.cancelled() for future in self.waiters)
+
+    def set_result(self, result):
+        for future in self.waiters:
+            if not future.done():
+                future.set_result(result)
+
+    def set_exception(self, exception: Exception):
+        for future in self.waiters:
+            if not future.done():
+                future.set_exception(exception)
+
+    def cancel(self):
+        for future in self.waiters:
+            future.cancel()
+
+
+class _ChannelQueue:
+    __slots__ = ("jobs", "buckets", "pending_edits", "wake", "worker", "current")
+
+    def __init__(self):
+        self.jobs = deque()
+        self.buckets = {route: RateBucket(*limit) for route, limit in ROUTE_LIMITS.items()}
+        self.pending_edits: Dict[int, _Job] = {}
+        self.wake = asyncio.Event()
+        self.worker: Optional[asyncio.Task] = None
+        self.current: Optional[_Job] = None
+
+
+class Outbound:
+    """Outbound message pipeline with a queue per channel
+
+    Every send, edit and reaction change goes through the channel's queue and waits for its route bucket, repeated edits
+    to a message that are still waiting in the queue are merged into the latest one, and reactions are added as a
+    single job.
+
+    Merged edits are counted in `outbound.coalesced_edits`, 429s that got through anyway in `outbound.rate_limited`
+    and the seconds from queueing to finishing a job in `outbound.latency.<route>`.
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.channels: Dict[int, _ChannelQueue] = {}
+        self.global_bucket = RateBucket(*GLOBAL_LIMIT)
+        self.metrics = metrics
+
+    def _enqueue(self, channel_id: int, job: _Job) -> asyncio.Future:
+        queue = self.channels.get(channel_id)
+        if queue is None:
+            queue = self.channels[channel_id] = _ChannelQueue()
+        queue.jobs.append(job)
+        if job.route == "edit":
+            queue.pending_edits[job.target.id] = job
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.ensure_future(self._work(channel_id, queue))
+        queue.wake.set()
+        return job.wait()
+
+    async def _work(self, channel_id: int, queue: _ChannelQueue):
+        tracing.detach()
+        while True:
+            if not queue.jobs:
+                queue.wake.clear()
+                try:
+                    await asyncio.wait_for(queue.wake.wait(), timeout=WORKER_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if not queue.jobs:
+                        del self.channels[channel_id]
+                        return
+                continue
+
+            job = queue.jobs.popleft()
+            if job.route == "edit" and queue.pending_edits.get(job.target.id) is job:
+                del queue.pending_edits[job.target.id]
+            # Everyone who queued the job was cancelled
+            if job.cancelled():
+                continue
+            queue.current = job
+            try:
+                with tracing.span(f"discord.{job.route}", parent=job.span, channel=channel_id):
+                    result = await self._perform(queue, job)
+            except Exception as e:
+                if isinstance(e, discord.HTTPException) and e.status == 429:
+                    self.metrics.increment("outbound.rate_limited")
+                job.set_exception(e)
+            else:
+                job.set_result(result)
+            finally:
+                queue.current = None
+                self.metrics.observe(f"outbound.latency.{job.route}", time.monotonic() - job.queued_at)
+
+    async def _perform(self, queue: _ChannelQueue, job: _Job):
+        bucket = queue.buckets[SHARED_LIMITS.get(job.route, job.route)]
+        if job.route in ("reaction", "remove_reaction"):
+            for emoji in job.emojis:
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+                if job.route == "reaction":
+                    await job.target.add_reaction(emoji)
+                else:
+                    await job.target.remove_reaction(emoji, job.kwargs["member"])
+            return None
+
+        await bucket.acquire()
+        await self.global_bucket.acquire()
+        if job.route == "send":
+            return await job.target.send(**job.kwargs)
+        if job.route == "clear_reactions":
+            return await job.target.clear_reactions()
+        return await job.target.edit(**job.kwargs)
+
+    async def drain(self, timeout: float):
+        """Waits up to `timeout` seconds for every queued job to finish"""
+        futures = []
+        for queue in self.channels.values():
+            if queue.current is not None:
+                futures.extend(queue.current.waiters)
+            for job in queue.jobs:
+                futures.extend(job.waiters)
+        if futures:
+            await asyncio.wait(futures, timeout=timeout)
+
+    def cancel_channel(self, channel_id: int):
+        """Drops the queued jobs of a deleted channel"""
+        queue = self.channels.pop(channel_id, None)
+        if queue is None:
+            return
+        for job in queue.jobs:
+            job.cancel()
+        if queue.current is not None:
+            queue.current.cancel()
+        if queue.worker is not None:
+            queue.worker.cancel()
+
+    def send(self, channel: Messageable, content: Optional[str] = None, **kwargs) -> asyncio.Future:
+        """Queues a message to be sent to the channel and returns a future of the sent `discord.Message`"""
+        kwargs["content"] = content
+        return self._enqueue(channel.id, _Job("send", channel, kwargs))
+
+    def edit(self, message: discord.Message, **kwargs) -> asyncio.Future:
+        """Queues an edit of the message. If an edit of the same message is still waiting, it's merged into this one"""
+        queue = self.channels.get(message.channel.id)
+        pending = queue.pending_edits.get(message.id) if queue else None
+        if pending is not None:
+            pending.kwargs.update(kwargs)
+            self.metrics.increment("outbound.coalesced_edits")
+            return pending.wait()
+        return self._enqueue(message.channel.id, _Job("edit", message, kwargs))
+
+    def add_reactions(self, message: discord.Message, *emojis: str) -> asyncio.Future:
+        """Queues reactions to be added to the message in order as a single job"""
+        return self._enqueue(message.channel.id, _Job("reaction", message, emojis=emojis))
+
+    def remove_reactions(self, message: discord.Message, member: discord.abc.Snowflake, *emojis: str) -> asyncio.Future:
+        """Queues reactions of the member to be removed from the message in order as a single job"""
+        return self._enqueue(message.channel.id, _Job("remove_reaction", message, {"member": member}, emojis))
+
+    def clear_reactions(self, message: discord.Message) -> asyncio.Future:
+        """Queues removing every reaction from the message"""
+        return self._enqueue(message.channel.id, _Job("clear_reactions", message))
@@ -0,0 +1,116 @@
+import os
+import re
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+
+SAFE = "safe"
+UNSAFE = "unsafe"
+UNSURE = "unsure"
+
+# Texts longer than this many words always go to the remote classifier
+MAX_SAFE_WORDS = 12
+
+_NON_WORD = re.compile(r"[^\w]+")
+_URL = re.compile(r"https?://|www\.", re.IGNORECASE)
+
+
+def normalize(text: str) -> str:
+    """Lowercases the text and turns everything that isn't a word character into single spaces"""
+    return " " + _NON_WORD.sub(" ", text.lower()).strip() + " "
+
+
+class AhoCorasick:
+    """Aho-Corasick automaton that finds all occurrences of many patterns in a single pass"""
+    __slots__ = ("goto", "fail", "output")
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[int]] = [[]]
+
+        for pattern in patterns:
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(len(pattern))
+
+        # Build failure links breadth first
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                if self.fail[next_state] == next_state:
+                    self.fail[next_state] = 0
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def find(self, text: str) -> Iterator[Tuple[int, int]]:
+        """Yields `(start, end)` spans of every pattern occurrence in the text"""
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for length in self.output[state]:
+                yield index - length + 1, index + 1
+
+
+def read_list(path: str) -> List[str]:
+    """Reads a word list file with one word or phrase per line, ignoring `#` comments"""
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return []
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+
+class Prefilter:
+    """Local first-stage content classifier
+
+    Texts containing a block list phrase are unsafe, short texts made up entirely of allow list phrases are safe,
+    and everything else is left to the remote classifier.
+    """
+
+    def __init__(self, block_list: Iterable[str], allow_list: Iterable[str]):
+        # Patterns are padded with spaces so they only match whole words
+        self.block = AhoCorasick(normalize(phrase) for phrase in block_list)
+        self.allow = AhoCorasick(normalize(phrase) for phrase in allow_list)
+
+    @classmethod
+    def from_path(cls, path: str) -> "Prefilter":
+        """Loads `block.txt` and `allow.txt` from given directory"""
+        return cls(read_list(os.path.join(path, "block.txt")), read_list(os.path.join(path, "allow.txt")))
+
+    def classify(self, text: str) -> str:
+        """Returns `UNSAFE`, `SAFE` or `UNSURE` for the text"""
+        if _URL.search(text):
+            return UNSURE
+
+        normalized = normalize(text)
+        for _ in self.block.find(normalized):
+            return UNSAFE
+
+        if normalized.count(" ") - 1 > MAX_SAFE_WORDS:
+            return UNSURE
+
+        # Safe only if every character except the separators is covered by an allowed phrase
+        covered = bytearray(len(normalized))
+        for start, end in self.allow.find(normalized):
+            covered[start:end] = b"\x01" * (end - start)
+        for index, char in enumerate(normalized):
+            if char != " " and not covered[index]:
+                return UNSURE
+        return SAFE
@@ -0,0 +1,68 @@
+import json
+import asyncio
+import logging
+from types import SimpleNamespace
+from typing import List, Union
+
+import discord.gateway
+import discord.http
+import discord.utils
+
+log = logging.getLogger("muffin.runtime")
+
+_loads = json.loads
+
+
+def json_loads(data: Union[str, bytes]):
+    """Parses JSON with orjson when fast runtime is enabled, otherwise with the standard library"""
+    return _loads(data)
+
+
+def _enable_uvloop() -> bool:
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def _enable_orjson() -> bool:
+    global _loads
+    try:
+        import orjson
+    except ImportError:
+        return False
+
+    def dumps(obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    _loads = orjson.loads
+
+    # discord.py reads gateway payloads and HTTP responses through the `json` module of these modules,
+    # and newer versions through the helpers in `discord.utils`
+    shim = SimpleNamespace(loads=orjson.loads, dumps=dumps, JSONDecodeError=orjson.JSONDecodeError)
+    for module in (discord.gateway, discord.http):
+        if getattr(module, "json", None) is json:
+            module.json = shim
+    if hasattr(discord.utils, "_from_json"):
+        discord.utils._from_json = orjson.loads
+    if hasattr(discord.utils, "to_json"):
+        discord.utils.to_json = dumps
+    return True
+
+
+def enable_fast_runtime() -> List[str]:
+    """Installs uvloop as the event loop policy and swaps in orjson for JSON handling, skipping the ones that
+    aren't installed. Must be called before the bot creates its event loop
+
+    :returns: Names of the enabled packages
+    """
+    enabled = []
+    if _enable_uvloop():
+        enabled.append("uvloop")
+    if _enable_orjson():
+        enabled.append("orjson")
+    if len(enabled) < 2:
+        log.warning(f"Fast runtime is missing packages, only enabled: {', '.join(enabled) or 'nothing'}")
+    return enabled
@@ -0,0 +1,29 @@
+import os
+import gzip
+import json
+import time
+from typing import Optional
+
+
+SNAPSHOT_VERSION = 2
+
+
+def save_snapshot(path: str, data: dict):
+    """Writes warm state to a gzipped JSON file, replacing the old snapshot atomically"""
+    data = {"version": SNAPSHOT_VERSION, "saved_at": time.time(), **data}
+    temp_path = path + ".tmp"
+    with gzip.open(temp_path, "wt", encoding="utf-8") as file:
+        json.dump(data, file, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+
+def load_snapshot(path: str) -> Optional[dict]:
+    """Reads a snapshot written by `save_snapshot`. Returns `None` if there is none or it's from another version"""
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            data = json.load(file)
+    except (OSError, EOFError, ValueError):
+        return None
+    if data.get("version") != SNAPSHOT_VERSION:
+        return None
+    return data
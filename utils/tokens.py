@@ -0,0 +1,10 @@
+import re
+
+# GPT-3's tokenizer splits English text into roughly one token per word or punctuation mark, and long words into a
+# token per four characters
+_PIECE = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates how many tokens the text is without loading a tokenizer"""
+    return sum(max(1, (len(piece) + 3) // 4) for piece in _PIECE.findall(text))
@@ -0,0 +1,111 @@
+import time
+import random
+import functools
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, List
+
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """A timed operation with tags and child spans"""
+    __slots__ = ("name", "tags", "start", "end", "wall_start", "children")
+
+    def __init__(self, name: str, tags: dict):
+        self.name = name
+        self.tags = tags
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.wall_start = time.time()
+        self.children: List[Span] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def detach():
+    """Stops the current task from adding spans to the trace it inherited from the task that created it"""
+    _current_span.set(None)
+
+
+@contextmanager
+def span(name: str, parent: Optional[Span] = None, **tags):
+    """Opens a child span of `parent` or the current span. Does nothing if there is no trace going on"""
+    parent = parent or _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, {key: value for key, value in tags.items() if value is not None})
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    finally:
+        child.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+def traced(name: Optional[str] = None):
+    """Decorator that runs the coroutine function in a child span named after it"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name or func.__qualname__):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Tracer:
+    """Opens root spans and keeps slow traces and a sample of the rest in a ring buffer
+
+    :param slow_threshold: Traces taking at least this many seconds are always kept
+    :param sample_rate: Share of the faster traces that are kept
+    :param capacity: Number of traces to keep, `None` keeps all of them
+    """
+
+    def __init__(self, slow_threshold: float = 2.0, sample_rate: float = 0.01, capacity: Optional[int] = 100):
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=capacity)
+
+    @contextmanager
+    def trace(self, name: str, **tags):
+        root = Span(name, {key: value for key, value in tags.items() if value is not None})
+        token = _current_span.set(root)
+        try:
+            yield root
+        finally:
+            root.end = time.perf_counter()
+            _current_span.reset(token)
+            if root.duration >= self.slow_threshold or random.random() < self.sample_rate:
+                self.traces.append(root)
+
+    def export_chrome(self) -> dict:
+        """Returns kept traces in Chrome trace event format, one thread per trace"""
+        events = []
+        for index, root in enumerate(self.traces):
+            base = root.wall_start * 1e6 - root.start * 1e6
+            stack = [root]
+            while stack:
+                current = stack.pop()
+                events.append({
+                    "name": current.name,
+                    "ph": "X",
+                    "ts": base + current.start * 1e6,
+                    "dur": current.duration * 1e6,
+                    "pid": 1,
+                    "tid": index,
+                    "args": current.tags
+                })
+                stack.extend(current.children)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
@@ -0,0 +1,105 @@
+import os
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from typing import List, Optional, Iterator
+
+from discord.ext import commands
+
+
+# Records are written to disk in batches of this size
+FLUSH_SIZE = 100
+
+# Annotations of the command parameters that are recorded as numbers
+NUMERIC_OPTIONS = (int, Optional[int])
+
+
+class TrafficRecord:
+    """A sanitized command invocation. Only sizes and leading numeric options are kept, never the text or user"""
+    __slots__ = ("time", "command", "chars", "numbers", "guild")
+
+    def __init__(self, time: float, command: str, chars: int, numbers: List[int], guild: Optional[str]):
+        self.time = time
+        self.command = command
+        self.chars = chars
+        self.numbers = numbers
+        self.guild = guild
+
+    def to_list(self) -> list:
+        return [round(self.time, 3), self.command, self.chars, self.numbers, self.guild]
+
+    @classmethod
+    def from_list(cls, data: list) -> "TrafficRecord":
+        return cls(*data)
+
+
+class TrafficRecorder:
+    """Records sanitized command traffic to a gzipped JSON lines file for replaying
+
+    Guild IDs are hashed with a key that's generated for the recording and kept next to it in `<path>.key`, so guilds
+    can be told apart within a recording, also across restarts, but not identified.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.key = self._load_key(path + ".key")
+        self.buffer: List[TrafficRecord] = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _load_key(path: str) -> bytes:
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            pass
+        key = os.urandom(16)
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as file:
+            file.write(key)
+        return key
+
+    def record(self, ctx: commands.Context):
+        invocation = f"{ctx.prefix}{ctx.invoked_with}"
+        arguments = ctx.message.content[len(invocation):].split()
+        # Only numbers the command parses as options like `max_tokens` are kept, numbers in the text count as text
+        options = 0
+        for param in ctx.command.clean_params.values():
+            if param.annotation not in NUMERIC_OPTIONS or options >= len(arguments) \
+                    or not arguments[options].isnumeric():
+                break
+            options += 1
+        guild = None
+        if ctx.guild is not None:
+            guild = hashlib.blake2b(str(ctx.guild.id).encode(), key=self.key, digest_size=8).hexdigest()
+        self.buffer.append(TrafficRecord(
+            time.time(),
+            ctx.command.qualified_name,
+            sum(len(word) for word in arguments[options:]),
+            [int(word) for word in arguments[:options]],
+            guild
+        ))
+        if len(self.buffer) >= FLUSH_SIZE:
+            records, self.buffer = self.buffer, []
+            asyncio.get_event_loop().run_in_executor(None, self._write, records)
+
+    def _write(self, records: List[TrafficRecord]):
+        # Every flush appends a new gzip member, which gzip readers read as one stream
+        with self.lock, gzip.open(self.path, "at", encoding="utf-8") as file:
+            for record in records:
+                file.write(json.dumps(record.to_list(), separators=(",", ":")) + "\n")
+
+    def flush(self):
+        """Writes buffered records synchronously"""
+        records, self.buffer = self.buffer, []
+        if records:
+            self._write(records)
+
+
+def read_traffic(path: str) -> Iterator[TrafficRecord]:
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield TrafficRecord.from_list(json.loads(line))